@@ -1 +1,3 @@
-__all__ = ["beautifier", "color", "util"]
+__all__ = ["archive", "batch", "beautifier", "cache", "color", "daemon", "diff", "edits", "git",
+           "jsonl", "limits", "shard", "util", "walk"]
+__version__ = "0.2"
@@ -0,0 +1,137 @@
+"""
+Beautifying the .cf members of tar and zip archives without extracting them.
+
+The members are read one at a time, so only one member is held in memory at a time. In write mode
+a new archive is written with the .cf members beautified, and the other members copied as is,
+keeping the metadata (names, times, permissions, owners) of all the members.
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+from . import batch
+from .util import atomically_written
+import copy
+import io
+import shutil
+import sys
+import tarfile
+import zipfile
+
+class ArchiveError(Exception):
+    "The archive cannot be read or written"
+
+class _Discarded(Exception):
+    "The archive is not written, as some members could not be beautified"
+
+def _is_cf(name):
+    return name.endswith(".cf")
+
+def _tar_write_mode(path):
+    "Return tarfile stream mode for writing an archive at path, by its extension"
+    for extensions, compression in [((".tar.gz", ".tgz"), "gz"),
+                                    ((".tar.bz2", ".tbz2", ".tbz"), "bz2"),
+                                    ((".tar.xz", ".txz"), "xz")]:
+        if path.endswith(extensions):
+            return "w|" + compression
+    return "w|"
+
+def _member_result(name, data, settings):
+    "Return FileResult of the member with data as bytes, an error if not UTF-8"
+    return batch.beautify_string(name, data, settings)
+
+def _tar_results(path, output, settings, write_mode = "w|"):
+    """
+    Yield FileResult of each .cf member, and write the archive to output file if given, in tarfile
+    write_mode
+    """
+    # Streams (in both directions), so the archive does not have to fit in memory
+    with tarfile.open(path, "r|*") as archive:
+        with (tarfile.open(fileobj = output, mode = write_mode) if output
+                  else _NoArchive()) as new_archive:
+            for member in archive:
+                if member.isfile() and _is_cf(member.name):
+                    data = archive.extractfile(member).read()
+                    result = _member_result(member.name, data, settings)
+                    yield result
+                    if result.status == "beautified":
+                        data = result.output.encode("utf-8")
+                        member = copy.copy(member)
+                        member.size = len(data)
+                    new_archive.addfile(member, io.BytesIO(data))
+                else:
+                    new_archive.addfile(member,
+                                        archive.extractfile(member) if member.isfile() else None)
+
+def _zip_results(path, output, settings):
+    "Yield FileResult of each .cf member, and write the archive to output file if given"
+    with zipfile.ZipFile(path) as archive:
+        with (zipfile.ZipFile(output, "w", allowZip64 = True) if output
+                  else _NoArchive()) as new_archive:
+            new_archive.comment = archive.comment
+            for info in archive.infolist():
+                if _is_cf(info.filename):
+                    data = archive.read(info)
+                    result = _member_result(info.filename, data, settings)
+                    yield result
+                    if result.status == "beautified":
+                        data = result.output.encode("utf-8")
+                    # Writing updates the sizes and offsets of the info
+                    new_archive.writestr(copy.copy(info), data)
+                elif output:
+                    _copy_zip_member(archive, info, new_archive)
+
+def _copy_zip_member(archive, info, new_archive):
+    "Copy the member in chunks, so that it does not have to fit in memory"
+    if sys.version_info < (3, 6): # ZipFile cannot be written in chunks
+        new_archive.writestr(copy.copy(info), archive.read(info))
+        return
+    with archive.open(info) as source:
+        with new_archive.open(copy.copy(info), "w") as destination:
+            shutil.copyfileobj(source, destination)
+
+class _NoArchive(object):
+    "Stands in for the new archive when not writing one"
+    def __enter__(self):
+        return self
+    def __exit__(self, *exception_info):
+        return False
+    def addfile(self, member, member_file = None):
+        pass
+    def writestr(self, info, data):
+        pass
+
+def beautified_members(path, settings, output_path = None):
+    """
+    Beautify the .cf members of the tar (possibly compressed) or zip archive at path, according to
+    settings, and yield FileResult of each, with the member name as the path. In write mode, writes
+    the archive with the beautified members to output_path (or over the archive if not given), once
+    all the members have been beautified without errors. Settings mode may be "write", "check" or
+    "diff". Raises ArchiveError if fails to read or write the archive.
+    """
+    try:
+        for result in _beautified_members(path, settings, output_path):
+            yield result
+    except (tarfile.TarError, zipfile.BadZipfile, EOFError, EnvironmentError) as error:
+        raise ArchiveError("%s: %s" % (path, error))
+
+def _beautified_members(path, settings, output_path):
+    if zipfile.is_zipfile(path):
+        results = _zip_results
+    else:
+        # Compressed by the extension of the archive written
+        write_mode = _tar_write_mode(output_path or path)
+        results = lambda path, output, settings: _tar_results(path, output, settings, write_mode)
+    if settings.mode != "write":
+        for result in results(path, None, settings):
+            yield result
+        return
+    try:
+        with atomically_written(output_path or path, settings.fsync == "file", "wb") as output:
+            has_errors = False
+            for result in results(path, output, settings):
+                has_errors = has_errors or result.status == "error"
+                yield result
+            if has_errors:
+                raise _Discarded()
+    except _Discarded:
+        pass
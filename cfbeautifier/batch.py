@@ -0,0 +1,378 @@
+"""
+Beautifying many files, in this process or in a pool of worker processes.
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+from . import beautifier
+from . import cache
+from .util import ParserError, atomically_written
+from .version_abstraction import string_from_file, write_stream
+import collections
+import itertools
+import os
+import shutil
+import time
+
+# The number of files that are scheduled by their costs at a time, see beautified_files
+COST_WINDOW = 1000
+
+class Settings(object):
+    """
+    What to do with each file. Passed to the worker processes, so has to be picklable.
+    cache_directory: directory of the result cache, or None to not use the cache
+    mode: "write" to overwrite the changed files, "stdout" to write the outputs to stdout,
+          "check" to only check whether the files are beautiful, or "diff" to return the diffs
+          of the changes
+    directory: directory that the relative paths are relative to, None for the current directory
+    links_unchanged: when writing to output paths, hard link the files that are unchanged instead of
+                     writing them
+    fsync: "file" to flush each written file to disk before replacing the original with it, or
+           "never" (or "batch", where the caller flushes all at the end with util.sync)
+    time_limit: seconds that parsing and rendering a file may take, or None for no limit
+    memory_limit: megabytes that parsing and rendering a file may allocate, or None for no limit.
+                  See the limits module for where the limits apply.
+    """
+    def __init__(self, options, cache_directory, mode = "write", directory = None,
+                 links_unchanged = False, fsync = "never", time_limit = None, memory_limit = None):
+        self.options = options
+        self.cache_directory = cache_directory
+        self.mode = mode
+        self.directory = directory
+        self.links_unchanged = links_unchanged
+        self.fsync = fsync
+        self.time_limit = time_limit
+        self.memory_limit = memory_limit
+
+class FileResult(object):
+    """
+    status: "unchanged", "beautified", "written" (to stdout), "unformatted" (would be changed, in
+            check and diff modes), "error" or "exceeded" (took more time or memory than allowed
+            by settings, and was left as is)
+    is_cached: True if the result was found from the cache, without parsing the file
+    signature: cache.file_signature of the file before reading it, if the file is beautiful
+    output: beautified string, if written to stdout and not streamed already, or if beautified by
+            beautify_string in write mode, or the unified diff in diff mode
+    error: error message if status is "error" or "exceeded"
+    duration: seconds taken to beautify the file
+    worker: process id of the process that beautified the file
+    """
+    def __init__(self, path, status, is_cached = False, output = None, error = None,
+                 signature = None, duration = None, worker = None):
+        self.path = path
+        self.status = status
+        self.is_cached = is_cached
+        self.output = output
+        self.error = error
+        self.signature = signature
+        self.duration = duration
+        self.worker = worker
+
+def _timed(path, settings, function, *arguments):
+    """
+    Return the FileResult of function(*arguments) for the file at path, with its duration and
+    worker, or the "exceeded" result if it exceeds the limits of settings, see _limited.
+    """
+    from . import limits # On first use, to keep the startup of cf-beautify fast
+    started = time.time()
+    try:
+        result = function(*arguments)
+    except limits.LimitExceeded as error:
+        result = FileResult(path, "exceeded", error = str(error))
+    result.duration = time.time() - started
+    result.worker = os.getpid()
+    return result
+
+def _has_limits(settings):
+    return settings.time_limit != None or settings.memory_limit != None
+
+def _limited(settings):
+    """
+    Return a context manager that interrupts the block if it exceeds the limits of settings, see
+    limits.limited. Only parsing and rendering are limited, as interrupting a write could leave the
+    file or the cache entry written but reported as not, or half written.
+    """
+    from . import limits
+    return limits.limited(settings.time_limit, settings.memory_limit)
+
+def _result_cache(settings):
+    return (settings.cache_directory
+                and cache.ResultCache(settings.cache_directory, settings.options))
+
+def _beautified(input, settings, result_cache):
+    """
+    Return (output, is_cached) pair. In check mode, output is None if input is not beautiful.
+    Raises ParserError.
+    """
+    output = result_cache and result_cache.beautified(input)
+    if output != None:
+        return (output, True)
+    with _limited(settings):
+        if settings.mode == "check":
+            # Does not render the whole output if it differs
+            if beautifier.is_beautiful(input, settings.options):
+                output = input
+        else:
+            output = beautifier.beautified_string(input, settings.options)
+    if result_cache and output != None:
+        result_cache.record(input, output)
+    return (output, False)
+
+def _unreadable_result(path, error):
+    "Return FileResult of the file at path that cannot be read (or decoded as UTF-8)"
+    if isinstance(error, UnicodeDecodeError):
+        return FileResult(path, "error", error = "Not UTF-8: %s" % error)
+    return FileResult(path, "error", error = "Cannot read: %s" % error)
+
+def _compared_result(path, input, output, settings, is_cached, signature = None):
+    "Return FileResult of comparing output to input, when the file is not to be written"
+    if input == output:
+        return FileResult(path, "unchanged", is_cached, signature = signature)
+    if settings.mode == "check":
+        return FileResult(path, "unformatted", is_cached)
+    from . import diff
+    return FileResult(path, "unformatted", is_cached,
+                      output = diff.unified_diff(input, output, path))
+
+def _write_file(path, output, settings):
+    "Write output to the file at path atomically, see util.atomically_written"
+    with atomically_written(path, settings.fsync == "file") as file:
+        write_stream(file, output)
+
+def _write_mirrored(input_path, output_path, input, output, settings):
+    "Write output to output_path, or hard link it to input_path if unchanged and links_unchanged"
+    try:
+        os.makedirs(os.path.dirname(output_path))
+    except OSError: # Exists already (possibly created by another worker)
+        pass
+    # Replaced rather than written into, as it may be a hard link to the input file
+    if os.path.lexists(output_path):
+        os.remove(output_path)
+    if input == output and settings.links_unchanged:
+        try:
+            os.link(input_path, output_path)
+            return
+        except OSError: # For example on another file system
+            pass
+    _write_file(output_path, output, settings)
+    shutil.copymode(input_path, output_path)
+
+def beautify_file(path, settings, stdout = None, output_path = None):
+    """
+    Beautify the file at path according to settings, and return FileResult. If writing to stdout
+    and stdout stream is given, writes the output into it instead of returning it. In write mode,
+    if output_path is given, writes the output there (also if unchanged) instead of overwriting
+    the file at path.
+    """
+    return _timed(path, settings, _beautify_file, path, settings, stdout, output_path)
+
+def _beautify_file(path, settings, stdout, output_path):
+    result_cache = _result_cache(settings)
+    # The result and the diff have the path as given
+    full_path = os.path.join(settings.directory, path) if settings.directory else path
+    try:
+        # Before reading, so that if the file changes after reading, the signature does not match
+        signature = cache.file_signature(full_path)
+        input = string_from_file(full_path)
+    except (EnvironmentError, UnicodeDecodeError) as error:
+        return _unreadable_result(path, error)
+    try:
+        # Streamed only without the cache, as the cache needs the whole output to record it (and
+        # a hit saves rendering altogether), and without limits, so that the output is not written
+        # in part. Writing in place needs the whole output too, to compare it to the input.
+        if settings.mode == "stdout" and stdout and not result_cache and not _has_limits(settings):
+            beautifier.write_beautified(input, stdout, settings.options)
+            return FileResult(path, "written")
+        output, is_cached = _beautified(input, settings, result_cache)
+    except ParserError as error:
+        return FileResult(path, "error", error = str(error))
+    if settings.mode == "stdout":
+        if stdout:
+            write_stream(stdout, output)
+            return FileResult(path, "written", is_cached)
+        return FileResult(path, "written", is_cached, output = output)
+    if output_path and settings.mode == "write":
+        if settings.directory:
+            output_path = os.path.join(settings.directory, output_path)
+        _write_mirrored(full_path, output_path, input, output, settings)
+        return FileResult(path, "unchanged" if input == output else "beautified", is_cached)
+    if input == output or settings.mode != "write":
+        return _compared_result(path, input, output, settings, is_cached, signature)
+    _write_file(full_path, output, settings)
+    return FileResult(path, "beautified", is_cached)
+
+def beautify_string(path, input, settings):
+    """
+    Like beautify_file, but for input as the content of the file at path, which is not read or
+    written. input may be bytes, to be decoded as UTF-8. In write mode, the output of a changed
+    file is returned in FileResult.output.
+    """
+    return _timed(path, settings, _beautify_string, path, input, settings)
+
+def _beautify_string(path, input, settings):
+    if isinstance(input, bytes):
+        try:
+            input = input.decode("utf-8-sig")
+        except UnicodeDecodeError as error:
+            return _unreadable_result(path, error)
+    try:
+        output, is_cached = _beautified(input, settings, _result_cache(settings))
+    except ParserError as error:
+        return FileResult(path, "error", error = str(error))
+    if settings.mode == "write" and input != output:
+        return FileResult(path, "beautified", is_cached, output = output)
+    return _compared_result(path, input, output, settings, is_cached)
+
+def expected_costs(paths, settings, timings = None):
+    """
+    Return the expected times to beautify the files by their paths, in arbitrary units: the
+    durations of the files in timings (cache.Timings) where known, and otherwise the sizes of the
+    files, scaled by the time per byte of the timed files.
+    """
+    sizes = {}
+    durations = {}
+    for path in paths:
+        full_path = os.path.join(settings.directory, path) if settings.directory else path
+        try:
+            sizes[path] = os.path.getsize(full_path)
+        except OSError: # Reported when beautified
+            sizes[path] = 0
+        duration = timings and timings.duration(full_path)
+        if duration != None:
+            durations[path] = duration
+    timed_bytes = sum(sizes[path] for path in durations)
+    seconds_per_byte = sum(durations.values()) / timed_bytes if timed_bytes else 1.0
+    return dict((path, durations.get(path, sizes[path] * seconds_per_byte)) for path in paths)
+
+def job_count(jobs):
+    "jobs is a number or 'auto' for the number of CPUs"
+    if jobs == "auto":
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    return max(int(jobs), 1)
+
+def _beautify_file_in_worker(arguments):
+    return beautify_file(*arguments)
+
+def _beautify_string_in_worker(path_input_and_settings):
+    return beautify_string(*path_input_and_settings)
+
+def _start_worker():
+    from . import parser
+    parser.parser()
+
+def worker_pool(jobs, files_per_worker = None):
+    """
+    Return a pool of jobs worker processes for beautified_files, with the parser built. If
+    files_per_worker is given, each worker is replaced by a new one after that many files, so
+    that the memory a worker holds on to does not keep growing.
+    """
+    import multiprocessing
+    # Built before forking, so that the workers do not each build it
+    _start_worker()
+    return multiprocessing.Pool(jobs, initializer = _start_worker,
+                                maxtasksperchild = files_per_worker)
+
+def _windows(items, size):
+    "Yield lists of the next size items of items (an iterator), the last possibly shorter"
+    window = []
+    for item in items:
+        window.append(item)
+        if size <= len(window):
+            yield window
+            window = []
+    if window:
+        yield window
+
+def _results_in_order_of_costs(pool, function, arguments, costs):
+    """
+    Yield function(argument) of each of the arguments in order, computing each COST_WINDOW of them
+    in the order of their costs (costs(list of arguments) returns the list of their costs), highest
+    first. arguments may be an iterator, that is consumed a window ahead of the results. As with
+    imap, an exception is raised in its turn, after the results of the arguments preceding it.
+    """
+    # When the costliest are started last, the other workers may be left waiting for them at the
+    # end. The results computed ahead of their turn are held until then.
+    pending = collections.deque() # In the order of the arguments
+    for window in _windows(arguments, COST_WINDOW):
+        window_costs = costs(window)
+        async_results = [None] * len(window)
+        for index in sorted(range(len(window)), key = lambda index: -window_costs[index]):
+            async_results[index] = pool.apply_async(function, (window[index],))
+        pending.extend(async_results)
+        # The next window is scheduled before waiting, so that the workers are kept busy
+        while COST_WINDOW < len(pending):
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+def _results_in_pool(function, arguments, jobs, pool, costs = None, files_per_worker = None):
+    """
+    Yield function(argument) of each of the arguments, computed in pool, or a new pool of jobs
+    (see worker_pool). If costs is given, the costliest are computed first, see
+    _results_in_order_of_costs.
+    """
+    owns_pool = not pool
+    if owns_pool:
+        # Not started for no arguments, for example when the input is read from stdin
+        arguments = iter(arguments)
+        try:
+            first_argument = next(arguments)
+        except StopIteration:
+            return
+        arguments = itertools.chain([first_argument], arguments)
+        pool = worker_pool(jobs, files_per_worker)
+    try:
+        # imap keeps the order. A chunk size of 1 also keeps an unexpected exception from hiding
+        # the results of the files preceding it.
+        results = (_results_in_order_of_costs(pool, function, arguments, costs) if costs
+                       else pool.imap(function, arguments))
+        for result in results:
+            yield result
+        if owns_pool:
+            pool.close()
+    finally:
+        if owns_pool:
+            pool.terminate()
+            pool.join()
+
+def beautified_files(paths, settings, jobs = 1, stdout = None, pool = None, output_paths = {},
+                     costs = None, files_per_worker = None):
+    """
+    Beautify the files, and yield FileResult of each in the order of paths. With more than one
+    job, or if a worker_pool is given, the files are beautified (and written) in a pool of worker
+    processes. A given pool is left running, to be used again. paths may be an iterator, that is
+    consumed as the files are beautified. output_paths are the paths to write the files to by their
+    paths, see beautify_file. It may be filled in as paths is consumed. If costs are given, the pool
+    beautifies the costliest files of each COST_WINDOW first, so that the run is not left waiting
+    for a large file started last. costs is a dict of the expected costs by path, or a function
+    that returns it for a list of paths, see expected_costs. files_per_worker is passed to
+    worker_pool, when not given a pool.
+    """
+    path_count = len(paths) if hasattr(paths, "__len__") else None
+    if not pool and (jobs <= 1 or path_count != None and path_count <= 1):
+        return (beautify_file(path, settings, stdout, output_paths.get(path)) for path in paths)
+    def argument_costs(arguments):
+        path_costs = (costs([argument[0] for argument in arguments]) if callable(costs)
+                          else costs)
+        return [path_costs.get(argument[0], 0) for argument in arguments]
+    return _results_in_pool(_beautify_file_in_worker,
+                            ((path, settings, None, output_paths.get(path)) for path in paths),
+                            min(jobs, path_count) if path_count != None else jobs,
+                            pool,
+                            costs != None and argument_costs,
+                            files_per_worker)
+
+def beautified_strings(paths_and_inputs, settings, jobs = 1, files_per_worker = None):
+    """
+    Like beautified_files, but for (path, content) pairs of the files, which are not read or
+    written, see beautify_string. paths_and_inputs may be an iterator, that is consumed as the
+    files are beautified.
+    """
+    if jobs <= 1:
+        return (beautify_string(path, input, settings) for path, input in paths_and_inputs)
+    return _results_in_pool(_beautify_string_in_worker,
+                            ((path, input, settings) for path, input in paths_and_inputs),
+                            jobs,
+                            None,
+                            files_per_worker = files_per_worker)
@@ -1,8 +1,10 @@
 from __future__ import absolute_import
 from __future__ import print_function
 from __future__ import unicode_literals
-from . import parser
-from . import structure
+# The parser, structure and edits modules are imported on first use, as importing them (and
+# building the parser) takes most of the startup time of cf-beautify
+from .util import ParserError, atomically_written
+from .version_abstraction import text_writer
 import copy
 
 class Options(object):
@@ -12,6 +14,9 @@ class Options(object):
         self.page_width = 500
         self.line_endings = None
 
+# The names of the line endings, None to detect them from the input
+LINE_ENDINGS = { "windows": "\r\n", "unix": "\n", "detect": None }
+
 def line_endings(string, line_endings):
     if line_endings:
         return line_endings
@@ -19,9 +24,119 @@ def line_endings(string, line_endings):
         return "\r\n"
     return "\n"
 
+def _parsed(string, options):
+    "Return (specification, structure options) pair"
+    from . import parser
+    from . import structure
+    options = copy.copy(options) or Options()
+    options.line_endings = line_endings(string, options.line_endings)
+    options = structure.Options(options)
+    return (parser.specification_from_string(string, options), options)
+
 def beautified_string(string, options = None):
     "Raises ParserError if fails to parse"
+    specification, options = _parsed(string, options)
+    return specification.to_string(options)
+
+class _Differs(Exception):
+    pass
+
+class _ComparingStream(object):
+    "Compares the text written into it with the string, raises _Differs at the first difference"
+    def __init__(self, string):
+        self.string = string
+        self.pos = 0
+    def write(self, text):
+        if not self.string.startswith(text, self.pos):
+            raise _Differs()
+        self.pos += len(text)
+
+def is_beautiful(string, options = None):
+    """
+    Return True if beautifying would not change the string. The output is compared to the string
+    while rendering, and rendering stops at the first difference. Raises ParserError if fails to
+    parse.
+    """
+    specification, options = _parsed(string, options)
+    stream = _ComparingStream(string)
+    try:
+        # A small buffer, so that little is rendered after the first difference
+        specification.write(stream, options, buffer_size = 1024)
+    except _Differs:
+        return False
+    return stream.pos == len(string)
+
+def beautified_range(string, start_line_number, end_line_number, options = None):
+    """
+    Return the string with only the top level bundles and bodies that are on the given lines
+    (1-based, inclusive) beautified. The rest of the string is returned as is. Only those blocks
+    are parsed and rendered. Raises ParserError if fails to parse.
+    """
+    from . import parser
+    spans = parser.top_level_block_lines(string)
+    def overlapping(first, last):
+        return [span for span in spans if span[0] <= last and first <= span[1]]
+    selected = overlapping(start_line_number, end_line_number)
+    if not selected:
+        return string
+    # A block starting or ending on a line of the selected blocks has to be beautified with them
+    first, last = selected[0][0], selected[-1][1]
+    while True:
+        selected = overlapping(first, last)
+        if (selected[0][0], selected[-1][1]) == (first, last):
+            break
+        first, last = min(first, selected[0][0]), max(last, selected[-1][1])
+
+    def line_start_pos(line_number):
+        pos = 0
+        for i in range(line_number - 1):
+            pos = string.index("\n", pos) + 1
+        return pos
+    start_pos = line_start_pos(first)
+    # Up to (excluding) the line ending of the last line
+    end_pos = string.find("\n", line_start_pos(last))
+    if end_pos == -1:
+        end_pos = len(string)
+    elif string[end_pos - 1:end_pos] == "\r":
+        end_pos -= 1
+
     options = copy.copy(options) or Options()
     options.line_endings = line_endings(string, options.line_endings)
-    options = structure.Options(options)
-    return parser.specification_from_string(string, options).to_string(options)
+    try:
+        beautified = beautified_string(string[start_pos:end_pos], options)
+    except ParserError as error:
+        # With the line number and position in the whole string. The slice starts at the start of
+        # a line, so the column is the same.
+        raise ParserError(error.fragment, error.line_number + first - 1, string,
+                          error.position + start_pos)
+    # The blocks end with a line ending, but the replaced text does not
+    if beautified.endswith(options.line_endings):
+        beautified = beautified[:-len(options.line_endings)]
+    return string[:start_pos] + beautified + string[end_pos:]
+
+def beautified_edits(string, options = None):
+    """
+    Return a list of (start_pos, end_pos, replacement) edits that beautify the string, see
+    edits.text_edits. Editors can apply these instead of replacing the whole text, which keeps
+    the selections, folds and undo history of the unchanged parts. Raises ParserError if fails to
+    parse.
+    """
+    from . import edits
+    return edits.text_edits(string, beautified_string(string, options))
+
+def write_beautified(string, stream, options = None):
+    """
+    Write the beautified string into the stream, without building the whole output string in
+    memory. Raises ParserError if fails to parse, in which case nothing is written.
+    """
+    specification, options = _parsed(string, options)
+    specification.write(text_writer(stream), options)
+
+def write_beautified_file(string, path, options = None, fsyncs = False):
+    """
+    Write the beautified string to the file at path, atomically (see util.atomically_written).
+    Raises ParserError if fails to parse, in which case the file is not touched.
+    """
+    specification, options = _parsed(string, options)
+    with atomically_written(path, fsyncs) as file:
+        specification.write(text_writer(file), options)
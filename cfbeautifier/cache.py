@@ -0,0 +1,235 @@
+"""
+On disk cache of beautifying results, so that unchanged files are not parsed again.
+
+The cache directory contains:
+results/ab/cdef... named by the hash of (beautifier version, options, input), containing either
+                   "formatted" if the input is beautiful as is, or the hash of the beautified output
+outputs/ab/cdef... named by the hash of a beautified output, containing the output
+index/abcd...      named by the hash of (beautifier version, options), containing the stat
+                   signatures of the files last seen beautiful, see StatIndex
+timings            the durations of beautifying the files when last parsed, see Timings
+size               the running total of the bytes in results/ and outputs/, see evict
+
+Entries are written to a temporary file and renamed into place, so the cache can be shared by
+parallel processes. Reading an entry updates its modification time, which is used to evict the
+least recently used results and outputs when the cache grows over its size limit. The cache is an
+optimization only, so failing to read or write it is ignored.
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+from . import __version__
+import io
+import os
+# hashlib, json and tempfile are imported on first use, to keep the startup of cf-beautify fast
+
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+FORMATTED = "formatted"
+
+def default_directory():
+    "Per user cache directory, $XDG_CACHE_HOME/cf-beautifier or ~/.cache/cf-beautifier"
+    return os.path.join(os.environ.get("XDG_CACHE_HOME")
+                            or os.path.join(os.path.expanduser("~"), ".cache"),
+                        "cf-beautifier")
+
+def options_key(options):
+    "Return a string that identifies the beautifier version and the options that affect output"
+    return "%s %r" % (__version__, sorted(vars(options).items()))
+
+def content_hash(string):
+    import hashlib
+    return hashlib.sha256(string.encode("utf-8")).hexdigest()
+
+def _read(path):
+    "Return the content of the file at path, or None if cannot read it"
+    try:
+        with io.open(path, "r", encoding = "utf-8", newline = "") as file:
+            content = file.read()
+        os.utime(path, None)
+        return content
+    except (IOError, OSError):
+        return None
+
+def _write_atomically(path, content):
+    """
+    Write content to the file at path, so that readers never see a partially written file. Return
+    the number of bytes written.
+    """
+    import tempfile
+    try:
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError: # Exists already (possibly created by another process), or cannot create
+            pass
+        descriptor, temp_path = tempfile.mkstemp(dir = os.path.dirname(path), prefix = ".tmp")
+        with io.open(descriptor, "w", encoding = "utf-8", newline = "") as file:
+            file.write(content)
+        os.rename(temp_path, path)
+        return len(content.encode("utf-8"))
+    except (IOError, OSError):
+        return 0
+
+def _add_size(directory, byte_count):
+    """
+    Add byte_count to the running total in the size file. The count is appended as a line, which
+    parallel processes can do without losing each other's counts.
+    """
+    try:
+        with io.open(os.path.join(directory, "size"), "a", encoding = "utf-8") as file:
+            file.write("%d\n" % byte_count)
+    except (IOError, OSError):
+        pass
+
+class ResultCache(object):
+    "Cache of beautifying results with the given beautifier options"
+    def __init__(self, directory, options):
+        self.directory = directory
+        self.options_key = options_key(options)
+
+    def _path(self, kind, hash_string):
+        return os.path.join(self.directory, kind, hash_string[:2], hash_string[2:])
+
+    def _result_path(self, input):
+        return self._path("results", content_hash(self.options_key + "\0" + input))
+
+    def beautified(self, input):
+        "Return the beautified string of input, or None if not in the cache"
+        result = _read(self._result_path(input))
+        if result == FORMATTED:
+            return input
+        elif result:
+            return _read(self._path("outputs", result))
+        return None
+
+    def record(self, input, output):
+        "Record that output is the beautified string of input"
+        if input == output:
+            byte_count = _write_atomically(self._result_path(input), FORMATTED)
+        else:
+            output_hash = content_hash(output)
+            byte_count = (_write_atomically(self._path("outputs", output_hash), output)
+                              + _write_atomically(self._result_path(input), output_hash))
+        _add_size(self.directory, byte_count)
+
+def _total_size(size_path):
+    "Return the running total of the size file, or None if cannot read it"
+    content = _read(size_path)
+    try:
+        return sum(map(int, content.split())) if content != None else None
+    except ValueError:
+        return None
+
+def evict(directory, max_bytes = DEFAULT_MAX_BYTES):
+    """
+    Remove the least recently used results and outputs until they take at most max_bytes. The
+    entries are only listed when the running total of their sizes is over max_bytes (or unknown),
+    and the total is then set to their actual size. The total overestimates the size when entries
+    are written again, and misses the counts added while it is being set, which only makes the
+    entries listed sooner or later than needed.
+    """
+    size_path = os.path.join(directory, "size")
+    total_bytes = _total_size(size_path)
+    if total_bytes != None and total_bytes <= max_bytes:
+        # Keep the size file short
+        _write_atomically(size_path, "%d\n" % total_bytes)
+        return
+    entries = []
+    total_bytes = 0
+    for kind in ["results", "outputs"]:
+        for root, sub_folders, files in os.walk(os.path.join(directory, kind)):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError: # Removed by another process
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total_bytes += stat.st_size
+    entries.sort()
+    for mtime, size, path in entries:
+        if total_bytes <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total_bytes -= size
+    _write_atomically(size_path, "%d\n" % total_bytes)
+
+def file_signature(path):
+    "Return [size, modification time in nanoseconds, inode] of the file at path"
+    stat = os.stat(path)
+    mtime_ns = getattr(stat, "st_mtime_ns", None) or int(stat.st_mtime * 1000000000)
+    return [stat.st_size, mtime_ns, stat.st_ino]
+
+class _PathIndex(object):
+    """
+    Values by the absolute paths of files, stored as JSON in the file at path. Saving merges the
+    updates into the index as it is on disk then, so parallel runs only lose each other's updates
+    if they save at the same moment.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.values = self._loaded()
+        self.updates = {}
+
+    def _loaded(self):
+        import json
+        content = _read(self.path)
+        try:
+            return json.loads(content) if content else {}
+        except ValueError:
+            return {}
+
+    def _key(self, path):
+        return os.path.abspath(path)
+
+    def save(self):
+        import json
+        if self.updates:
+            values = self._loaded()
+            values.update(self.updates)
+            _write_atomically(self.path, json.dumps(values))
+
+class StatIndex(_PathIndex):
+    """
+    Index of the stat signatures of the files that were beautiful when last seen, so that a file
+    whose signature has not changed since does not have to be read. There is one index per
+    beautifier version and options, so changing either invalidates the index. Losing updates
+    only makes files read again.
+    """
+    def __init__(self, directory, options):
+        _PathIndex.__init__(self,
+                            os.path.join(directory, "index", content_hash(options_key(options))))
+
+    @property
+    def signatures(self):
+        return self.values
+
+    def is_unchanged(self, path):
+        "Return True if the file at path is beautiful when last seen, and has not changed since"
+        signature = self.values.get(self._key(path))
+        try:
+            return signature != None and signature == file_signature(path)
+        except OSError:
+            return False
+
+    def record(self, path, signature):
+        "Record that the file at path with the signature (taken before reading it) is beautiful"
+        self.updates[self._key(path)] = signature
+
+class Timings(_PathIndex):
+    """
+    Index of the seconds taken to beautify the files when last parsed, to schedule the files that
+    take longest first. The durations hardly depend on the options, so the index is shared by all.
+    """
+    def __init__(self, directory):
+        _PathIndex.__init__(self, os.path.join(directory, "timings"))
+
+    def duration(self, path):
+        "Return the seconds taken to beautify the file at path when last parsed, or None"
+        return self.updates.get(self._key(path), self.values.get(self._key(path)))
+
+    def record(self, path, duration):
+        self.updates[self._key(path)] = duration
@@ -0,0 +1,274 @@
+"""
+Long-lived beautifier server on a Unix socket, and its client.
+
+The server keeps the parser tables and a pool of worker processes warm, so that a client does not
+pay for them on each run. A client sends one request as a line of JSON, and the server answers with
+lines of JSON:
+{"kind": "files", "paths": [...], "output_paths": {...}, "costs": {...} or null, "directory": ...,
+ "options": {...}, "cache_directory": ..., "mode": ..., "links_unchanged": ..., "fsync": ...,
+ "time_limit": ..., "memory_limit": ..., "version": ...}
+    is answered with a line of FileResult attributes per path, in order
+{"kind": "string", "string": ..., "options": {...}, "version": ...}
+    is answered with {"output": ...}, or {"error": {...ParserError attributes}}
+A request of another beautifier version is answered with {"error": "version"}, in which case the
+client beautifies in process. An unexpected exception is answered with {"exception": traceback}.
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+from . import __version__
+import os
+import sys
+import time
+# The other modules are imported on first use, as the client imports this module on each run of
+# cf-beautify
+
+DEFAULT_IDLE_TIMEOUT = 30 * 60
+
+def default_socket_path(cache_directory):
+    return os.path.join(cache_directory, "daemon.sock")
+
+def _send(connection_file, message):
+    import json
+    connection_file.write((json.dumps(message) + "\n").encode("utf-8"))
+    connection_file.flush()
+
+def _received(connection_file):
+    "Return the next message, or None if the connection is closed"
+    import json
+    line = connection_file.readline()
+    return json.loads(line.decode("utf-8")) if line else None
+
+def _options(options_dict):
+    from . import beautifier
+    options = beautifier.Options()
+    options.__dict__.update(options_dict)
+    return options
+
+### Client
+
+class VersionMismatch(Exception):
+    "The running daemon is of another beautifier version"
+
+class DaemonError(Exception):
+    "Unexpected exception in the daemon, with the traceback as the message"
+
+def connected(socket_path):
+    "Return a socket connected to the daemon, or None if the daemon is not running"
+    import socket
+    if not os.path.exists(socket_path):
+        return None
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(socket_path)
+        return connection
+    except socket.error:
+        connection.close()
+        return None
+
+def _requested(connection, request):
+    """
+    Send the request, and return a generator of the response messages. Raises VersionMismatch
+    if the daemon cannot be used.
+    """
+    import socket
+    request["version"] = __version__
+    connection_file = connection.makefile("rwb")
+    def close():
+        connection_file.close()
+        connection.close()
+    try:
+        _send(connection_file, request)
+        first_message = _received(connection_file)
+    except socket.error:
+        close()
+        raise VersionMismatch() # Could not talk to it, so cannot use it either
+    if first_message == { "error": "version" }:
+        close()
+        raise VersionMismatch()
+    def messages():
+        try:
+            message = first_message
+            while message != None:
+                if "exception" in message:
+                    raise DaemonError(message["exception"])
+                yield message
+                message = _received(connection_file)
+        finally:
+            close()
+    return messages()
+
+def beautified_files(connection, paths, settings, output_paths = {}, costs = None):
+    """
+    Like batch.beautified_files, but beautified by the daemon. Raises VersionMismatch before
+    yielding anything, if the daemon cannot be used.
+    """
+    from . import batch
+    request = { "kind": "files",
+                "paths": paths,
+                "output_paths": output_paths,
+                "costs": costs,
+                "directory": os.getcwd(),
+                "options": vars(settings.options),
+                "cache_directory": settings.cache_directory,
+                "mode": settings.mode,
+                "links_unchanged": settings.links_unchanged,
+                "fsync": settings.fsync,
+                "time_limit": settings.time_limit,
+                "memory_limit": settings.memory_limit }
+    return (batch.FileResult(**message) for message in _requested(connection, request))
+
+def beautified_string(connection, string, options):
+    """
+    Like beautifier.beautified_string, but beautified by the daemon. Raises VersionMismatch if the
+    daemon cannot be used.
+    """
+    request = { "kind": "string", "string": string, "options": vars(options) }
+    for message in _requested(connection, request):
+        if "error" in message:
+            from .util import ParserError
+            error = message["error"]
+            raise ParserError(error["fragment"], error["line_number"], string, error["position"])
+        return message["output"]
+
+### Server
+
+def _string_response(string, options):
+    "Return the response to a string request, in a worker process"
+    from . import beautifier
+    from .util import ParserError
+    try:
+        return { "output": beautifier.beautified_string(string, options) }
+    except ParserError as error:
+        return { "error": { "fragment": error.fragment,
+                            "line_number": error.line_number,
+                            "position": error.position } }
+
+class _Server(object):
+    def __init__(self, socket_path, jobs, idle_timeout, files_per_worker):
+        import threading
+        from . import batch
+        self.socket_path = socket_path
+        self.idle_timeout = idle_timeout
+        self.pool = batch.worker_pool(jobs, files_per_worker)
+        self.lock = threading.Lock()
+        self.active_count = 0
+        self.last_activity = time.time()
+
+    def _set_active(self, is_active):
+        with self.lock:
+            self.active_count += 1 if is_active else -1
+            self.last_activity = time.time()
+
+    def is_idle(self):
+        with self.lock:
+            return (self.active_count == 0
+                        and self.idle_timeout < time.time() - self.last_activity)
+
+    def handle(self, connection):
+        import socket
+        import traceback
+        self._set_active(True)
+        connection_file = connection.makefile("rwb")
+        try:
+            request = _received(connection_file)
+            if request:
+                if request.get("version") != __version__:
+                    _send(connection_file, { "error": "version" })
+                else:
+                    for message in self._responses(request):
+                        _send(connection_file, message)
+        except socket.error: # Client went away, for example with --fail-fast
+            pass
+        except Exception:
+            try:
+                _send(connection_file, { "exception": traceback.format_exc() })
+            except socket.error:
+                pass
+        finally:
+            connection_file.close()
+            connection.close()
+            self._set_active(False)
+
+    def _responses(self, request):
+        from . import batch
+        options = _options(request["options"])
+        if request["kind"] == "string":
+            # Not parsed in the threads of this process, as the pool forks new workers from it at
+            # any time, and a worker forked while a thread holds the parser lock would hang
+            yield self.pool.apply(_string_response, (request["string"], options))
+        else:
+            settings = batch.Settings(options,
+                                      request["cache_directory"],
+                                      request["mode"],
+                                      request["directory"],
+                                      request["links_unchanged"],
+                                      request["fsync"],
+                                      request["time_limit"],
+                                      request["memory_limit"])
+            for result in batch.beautified_files(request["paths"],
+                                                 settings,
+                                                 pool = self.pool,
+                                                 output_paths = request["output_paths"],
+                                                 costs = request["costs"]):
+                yield vars(result)
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+
+def serve(socket_path, jobs, idle_timeout = DEFAULT_IDLE_TIMEOUT, on_ready = None,
+          files_per_worker = None):
+    """
+    Serve requests on the socket until idle for idle_timeout seconds. Each connection is handled
+    in a thread, and the files are beautified in a pool of jobs worker processes (see
+    batch.worker_pool for files_per_worker). Raises EnvironmentError if a daemon is already
+    running on the socket.
+    """
+    import errno
+    import signal
+    import socket
+    import threading
+    existing = connected(socket_path)
+    if existing:
+        existing.close()
+        raise EnvironmentError(errno.EADDRINUSE, "Daemon is already running", socket_path)
+    try:
+        os.remove(socket_path) # Left by a daemon that did not exit cleanly
+    except OSError:
+        pass
+    try:
+        os.makedirs(os.path.dirname(socket_path))
+    except OSError: # Exists already
+        pass
+    server = _Server(socket_path, jobs, idle_timeout, files_per_worker)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # Only the user may connect, as the daemon reads and writes files as the user
+    previous_umask = os.umask(0o077)
+    try:
+        listener.bind(socket_path)
+    finally:
+        os.umask(previous_umask)
+    listener.listen(16)
+    listener.settimeout(1)
+    # Clean up also when terminated
+    signal.signal(signal.SIGTERM, lambda signal_number, frame: sys.exit(0))
+    if on_ready:
+        on_ready()
+    try:
+        while not server.is_idle():
+            try:
+                connection, address = listener.accept()
+            except socket.timeout:
+                continue
+            connection.settimeout(None)
+            thread = threading.Thread(target = server.handle, args = (connection,))
+            thread.daemon = True
+            thread.start()
+    finally:
+        listener.close()
+        try:
+            os.remove(socket_path)
+        except OSError:
+            pass
+        server.close()
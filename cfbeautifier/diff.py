@@ -0,0 +1,153 @@
+"""
+Unified diffs between the original and the beautified text.
+
+The lines are compared by ids (equal lines have equal ids, found by hashing), and aligned in time
+linear in the number of lines: after the common beginning and end, the lines that occur exactly
+once in both texts anchor the alignment, and only the short gaps between the anchors are aligned
+line by line. A gap that differs more than that is shown as replaced as a whole.
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+from . import edits
+import bisect
+
+# Maximum number of line insertions and deletions to align line by line between two anchors
+MAX_GAP_EDIT_DISTANCE = 100
+
+def split_lines(string):
+    "Return the lines of the string, each with its line ending (\\r\\n or \\n) if it has one"
+    lines = [line + "\n" for line in string.split("\n")]
+    lines[-1] = lines[-1][:-1]
+    if not lines[-1]:
+        lines.pop()
+    return lines
+
+def line_ids(a_lines, b_lines):
+    "Return (ids of a_lines, ids of b_lines) pair, where equal lines have equal ids"
+    ids = {}
+    def line_id(line):
+        return ids.setdefault(line, len(ids))
+    return (list(map(line_id, a_lines)), list(map(line_id, b_lines)))
+
+def _unique_anchors(a, b, a_start, a_end, b_start, b_end):
+    """
+    Return (index in a, index in b) pairs of the ids that occur once in both ranges, as the
+    longest sequence that is in order in both
+    """
+    def unique_indexes(ids, start, end):
+        counts = {}
+        for index in range(start, end):
+            counts[ids[index]] = counts.get(ids[index], 0) + 1
+        return dict([(ids[index], index) for index in range(start, end) if counts[ids[index]] == 1])
+    b_indexes = unique_indexes(b, b_start, b_end)
+    candidates = [(a_index, b_indexes[a_id])
+                  for a_id, a_index in sorted(unique_indexes(a, a_start, a_end).items(),
+                                              key = lambda item: item[1])
+                  if a_id in b_indexes]
+    # Longest increasing subsequence of the b indexes (patience sorting)
+    pile_tops = []
+    top_candidates = []
+    previous = [None] * len(candidates)
+    for index, (a_index, b_index) in enumerate(candidates):
+        pile = bisect.bisect_left(pile_tops, b_index)
+        if 0 < pile:
+            previous[index] = top_candidates[pile - 1]
+        if pile == len(pile_tops):
+            pile_tops.append(b_index)
+            top_candidates.append(index)
+        else:
+            pile_tops[pile] = b_index
+            top_candidates[pile] = index
+    anchors = []
+    index = top_candidates[-1] if top_candidates else None
+    while index != None:
+        anchors.append(candidates[index])
+        index = previous[index]
+    anchors.reverse()
+    return anchors
+
+def _gap_pairs(a, b, a_start, a_end, b_start, b_end):
+    "Return the (index in a, index in b) pairs of the lines kept between the anchors"
+    pairs = []
+    while a_start < a_end and b_start < b_end and a[a_start] == b[b_start]:
+        pairs.append((a_start, b_start))
+        a_start += 1
+        b_start += 1
+    suffix_pairs = []
+    while a_start < a_end and b_start < b_end and a[a_end - 1] == b[b_end - 1]:
+        a_end -= 1
+        b_end -= 1
+        suffix_pairs.append((a_end, b_end))
+    middle_pairs = edits.matching_index_pairs(a[a_start:a_end], b[b_start:b_end],
+                                              MAX_GAP_EDIT_DISTANCE) or []
+    pairs.extend([(i + a_start, j + b_start) for i, j in middle_pairs])
+    suffix_pairs.reverse()
+    return pairs + suffix_pairs
+
+def matching_line_pairs(a, b):
+    "Return (index in a, index in b) pairs of the line ids that are kept, in order"
+    pairs = []
+    a_start, b_start = 0, 0
+    for a_anchor, b_anchor in _unique_anchors(a, b, 0, len(a), 0, len(b)) + [(len(a), len(b))]:
+        pairs.extend(_gap_pairs(a, b, a_start, a_anchor, b_start, b_anchor))
+        if a_anchor < len(a):
+            pairs.append((a_anchor, b_anchor))
+        a_start, b_start = a_anchor + 1, b_anchor + 1
+    return pairs
+
+def _changes(pairs, a_length, b_length):
+    "Return (a_start, a_end, b_start, b_end) of each changed range between the kept lines"
+    changes = []
+    a_start, b_start = 0, 0
+    for i, j in pairs + [(a_length, b_length)]:
+        if a_start < i or b_start < j:
+            changes.append((a_start, i, b_start, j))
+        a_start, b_start = i + 1, j + 1
+    return changes
+
+def _unified_range(start, end):
+    "As in the @@ line, for example '3,2' for 2 lines from the third line"
+    if end - start == 1:
+        return "%d" % (start + 1)
+    return "%d,%d" % (start + 1 if start < end else start, end - start)
+
+def unified_diff(original, beautified, path, context = 3):
+    """
+    Return the unified diff (as by diff -u) from original to beautified, or empty string if they
+    are equal
+    """
+    if original == beautified:
+        return ""
+    a_lines, b_lines = split_lines(original), split_lines(beautified)
+    a, b = line_ids(a_lines, b_lines)
+    changes = _changes(matching_line_pairs(a, b), len(a), len(b))
+    # Changes that are close to each other share a hunk
+    hunks = []
+    for change in changes:
+        if hunks and change[0] - hunks[-1][-1][1] <= 2 * context:
+            hunks[-1].append(change)
+        else:
+            hunks.append([change])
+
+    output = ["--- %s\t(original)\n" % path, "+++ %s\t(beautified)\n" % path]
+    def append_lines(prefix, lines):
+        for line in lines:
+            output.append(prefix + line)
+            if not line.endswith("\n"):
+                output.append("\n\\ No newline at end of file\n")
+    for hunk in hunks:
+        a_start = max(hunk[0][0] - context, 0)
+        a_end = min(hunk[-1][1] + context, len(a))
+        b_start = hunk[0][2] - (hunk[0][0] - a_start)
+        b_end = hunk[-1][3] + (a_end - hunk[-1][1])
+        output.append("@@ -%s +%s @@\n" % (_unified_range(a_start, a_end),
+                                           _unified_range(b_start, b_end)))
+        pos = a_start
+        for change_a_start, change_a_end, change_b_start, change_b_end in hunk:
+            append_lines(" ", a_lines[pos:change_a_start])
+            append_lines("-", a_lines[change_a_start:change_a_end])
+            append_lines("+", b_lines[change_b_start:change_b_end])
+            pos = change_a_end
+        append_lines(" ", a_lines[pos:a_end])
+    return "".join(output)
@@ -0,0 +1,166 @@
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+from . import lexer
+
+# Above this many token insertions and deletions, the middle part that differs is replaced as a whole
+# instead of being aligned token by token (alignment takes time proportional to the distance)
+MAX_EDIT_DISTANCE = 2000
+
+def tokens_and_block_starts(string):
+    """
+    Return ((start_pos, end_pos) of each token and comment in the string in order,
+            indexes of the tokens that start a top level block) pair
+    """
+    tokens, comments = lexer.all_tokens(string)
+    block_starts = set([tokens[first].lexpos for first, last in lexer.top_level_blocks(tokens)])
+    # Comments are not returned as tokens, but collected by the lexer
+    spans = sorted(map(lambda token: (token.lexpos, token.lexpos + len(token.value)),
+                       tokens + comments))
+    return (spans, [index for index, span in enumerate(spans) if span[0] in block_starts])
+
+def matching_index_pairs(a, b, max_edit_distance = MAX_EDIT_DISTANCE):
+    """
+    Return (index in a, index in b) pairs of the items that are kept in a shortest edit script
+    from a to b (Myers' algorithm), in order. Return None if the edit distance is greater than
+    max_edit_distance.
+    """
+    n, m = len(a), len(b)
+    max_d = min(n + m, max_edit_distance)
+    offset = max_d + 1
+    # x for each diagonal k (= x - y), at index offset + k
+    v = [0] * (2 * max_d + 3)
+    trace = []
+    for d in range(max_d + 1):
+        trace.append(list(v))
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and v[offset + k - 1] < v[offset + k + 1]):
+                x = v[offset + k + 1] # insertion
+            else:
+                x = v[offset + k - 1] + 1 # deletion
+            y = x - k
+            while x < n and y < m and a[x] == b[y]:
+                x += 1
+                y += 1
+            v[offset + k] = x
+            if n <= x and m <= y:
+                return _backtracked_pairs(trace, offset, n, m)
+    return None
+
+def _backtracked_pairs(trace, offset, n, m):
+    pairs = []
+    x, y = n, m
+    for d in range(len(trace) - 1, -1, -1):
+        v = trace[d]
+        k = x - y
+        if k == -d or (k != d and v[offset + k - 1] < v[offset + k + 1]):
+            previous_k = k + 1
+        else:
+            previous_k = k - 1
+        previous_x = v[offset + previous_k]
+        previous_y = previous_x - previous_k
+        while previous_x < x and previous_y < y:
+            x -= 1
+            y -= 1
+            pairs.append((x, y))
+        x, y = previous_x, previous_y
+    pairs.reverse()
+    return pairs
+
+def _aligned_token_pairs(a, b, max_edit_distance = MAX_EDIT_DISTANCE):
+    "Return (index in a, index in b) pairs of the tokens that are kept"
+    # Most of the tokens are normally equal, so align the differing middle only
+    prefix_count = 0
+    while prefix_count < min(len(a), len(b)) and a[prefix_count] == b[prefix_count]:
+        prefix_count += 1
+    suffix_count = 0
+    while (suffix_count < min(len(a), len(b)) - prefix_count
+           and a[-1 - suffix_count] == b[-1 - suffix_count]):
+        suffix_count += 1
+    middle_pairs = matching_index_pairs(a[prefix_count:len(a) - suffix_count],
+                                        b[prefix_count:len(b) - suffix_count],
+                                        max_edit_distance) or []
+    return ([(i, i) for i in range(prefix_count)]
+            + [(i + prefix_count, j + prefix_count) for i, j in middle_pairs]
+            + [(len(a) - suffix_count + i, len(b) - suffix_count + i) for i in range(suffix_count)])
+
+def _aligned_token_pairs_by_block(a, b, a_block_starts, b_block_starts):
+    """
+    The beautifier keeps the top level blocks in order, so each block is aligned separately with
+    the corresponding block. This keeps the alignment time proportional to the number of tokens,
+    as long as the blocks are not huge.
+    """
+    if len(a_block_starts) != len(b_block_starts):
+        return _aligned_token_pairs(a, b)
+    pairs = []
+    a_bounds = [0] + a_block_starts + [len(a)]
+    b_bounds = [0] + b_block_starts + [len(b)]
+    for index in range(len(a_bounds) - 1):
+        a_start, b_start = a_bounds[index], b_bounds[index]
+        pairs.extend([(i + a_start, j + b_start)
+                      for i, j in _aligned_token_pairs(a[a_start:a_bounds[index + 1]],
+                                                       b[b_start:b_bounds[index + 1]])])
+    return pairs
+
+def text_edits(original, beautified):
+    """
+    Return a list of (start_pos, end_pos, replacement) edits that turn original into beautified.
+    The positions are in original, and the edits are in order and do not overlap. The edits are
+    found by aligning the tokens of the strings, so normally only the white space between tokens
+    and the changed comments are replaced. Empty list means that the strings are equal.
+    """
+    if original == beautified:
+        return []
+    original_spans, original_block_starts = tokens_and_block_starts(original)
+    beautified_spans, beautified_block_starts = tokens_and_block_starts(beautified)
+    def texts(string, spans):
+        return [string[start:end] for start, end in spans]
+    pairs = _aligned_token_pairs_by_block(texts(original, original_spans),
+                                          texts(beautified, beautified_spans),
+                                          original_block_starts,
+                                          beautified_block_starts)
+    edits = []
+    # Compare the text between each two consecutive kept tokens (and the start and end of the
+    # strings). If tokens were removed or added in between, the text includes them.
+    original_end, beautified_end = 0, 0
+    for i, j in pairs + [(None, None)]:
+        if i == None:
+            original_start, beautified_start = len(original), len(beautified)
+        else:
+            original_start, beautified_start = original_spans[i][0], beautified_spans[j][0]
+        edit = _trimmed_edit(original, original_end, original_start,
+                             beautified[beautified_end:beautified_start])
+        if edit:
+            edits.append(edit)
+        if i != None:
+            original_end, beautified_end = original_spans[i][1], beautified_spans[j][1]
+    return edits
+
+def _trimmed_edit(original, start_pos, end_pos, replacement):
+    "Return the edit without the common prefix and suffix, or None if there is nothing to replace"
+    if original[start_pos:end_pos] == replacement:
+        return None
+    prefix_length = 0
+    max_length = min(end_pos - start_pos, len(replacement))
+    while (prefix_length < max_length
+           and original[start_pos + prefix_length] == replacement[prefix_length]):
+        prefix_length += 1
+    suffix_length = 0
+    max_length -= prefix_length
+    while (suffix_length < max_length
+           and original[end_pos - 1 - suffix_length] == replacement[-1 - suffix_length]):
+        suffix_length += 1
+    return (start_pos + prefix_length,
+            end_pos - suffix_length,
+            replacement[prefix_length:len(replacement) - suffix_length])
+
+def applied_edits(string, edits):
+    "Return the string with the edits (as returned by text_edits) applied"
+    parts = []
+    pos = 0
+    for start_pos, end_pos, replacement in edits:
+        parts.append(string[pos:start_pos])
+        parts.append(replacement)
+        pos = end_pos
+    parts.append(string[pos:])
+    return "".join(parts)
@@ -0,0 +1,102 @@
+"""
+Selecting files by their changes in git, and reading files from git without a checkout, using the
+git command line tool.
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+import os
+import subprocess
+import sys
+
+class GitError(Exception):
+    "git failed or could not be run, with the error output of git as the message"
+
+def _output(args, directory = None):
+    "Return the output of git with the args as bytes. Raises GitError if git fails."
+    try:
+        process = subprocess.Popen(["git"] + args,
+                                   cwd = directory,
+                                   stdout = subprocess.PIPE,
+                                   stderr = subprocess.PIPE)
+    except OSError as error:
+        raise GitError("Cannot run git: %s" % error)
+    out, err = process.communicate()
+    if process.returncode != 0:
+        raise GitError(err.decode("utf-8", "replace").strip())
+    return out
+
+def _paths(output):
+    "Return the paths of the NUL separated output of git"
+    return [path.decode(sys.getfilesystemencoding()) for path in output.split(b"\0") if path]
+
+def changed_paths(since = None, staged = False, pathspecs = [], directory = None):
+    """
+    Return the paths of the .cf files that have changed since the since revision, or that are
+    staged (changed in the index since since, or HEAD if since is not given). The paths are
+    relative to directory (None for the current directory), and only the files under directory
+    (or the pathspecs in it) are included. Deleted files are not included, and renamed files are
+    included by their new name. Raises GitError if git fails, for example if not in a git
+    repository.
+    """
+    # Lists the changes only, so the time taken depends on the number of changed files rather than
+    # the size of the repository. Without looking for renames, a renamed file is listed as added.
+    args = ["diff", "--name-only", "-z", "--relative", "--diff-filter=ACM", "--no-renames"]
+    if staged:
+        args.append("--cached")
+    if since:
+        args.append(since)
+    # Outside a repository, git diff would compare files instead
+    _output(["rev-parse", "--git-dir"], directory)
+    paths = _paths(_output(args + ["--"] + list(pathspecs), directory))
+    def exists(path):
+        # A staged file may have been deleted from the working tree since
+        return os.path.isfile(os.path.join(directory, path) if directory else path)
+    return [path for path in paths if path.endswith(".cf") and exists(path)]
+
+def tree_files(revision, pathspecs = [], directory = None):
+    """
+    Return (path, blob id) pairs of the .cf files in the revision, under directory (None for the
+    current directory) or the pathspecs in it, with the paths relative to directory. Raises
+    GitError if git fails.
+    """
+    files = []
+    for entry in _paths(_output(["ls-tree", "-r", "-z", revision, "--"] + list(pathspecs),
+                                directory)):
+        # <mode> SP <type> SP <blob id> TAB <path>
+        description, path = entry.split("\t", 1)
+        mode, kind, blob_id = description.split(" ")
+        is_symbolic_link = mode == "120000"
+        if kind == "blob" and not is_symbolic_link and path.endswith(".cf"):
+            files.append((path, blob_id))
+    return files
+
+def blob_contents(files, directory = None, decodes = True):
+    """
+    Yield (path, content) pair of each (path, blob id) pair in files, with the content as a
+    string (or as bytes unless decodes), read through one git cat-file process. Raises GitError if
+    a blob is not found, and UnicodeDecodeError if decodes and a blob is not UTF-8.
+    """
+    try:
+        process = subprocess.Popen(["git", "cat-file", "--batch"],
+                                   cwd = directory,
+                                   stdin = subprocess.PIPE,
+                                   stdout = subprocess.PIPE)
+    except OSError as error:
+        raise GitError("Cannot run git: %s" % error)
+    try:
+        # One blob at a time, so that neither pipe fills up while the other is waited for
+        for path, blob_id in files:
+            process.stdin.write(blob_id.encode("ascii") + b"\n")
+            process.stdin.flush()
+            # <blob id> SP <type> SP <size> LF <content> LF
+            header = process.stdout.readline().split()
+            if len(header) != 3:
+                raise GitError("Cannot read %s (%s)" % (path, blob_id))
+            content = process.stdout.read(int(header[2]))
+            process.stdout.read(1)
+            yield (path, content.decode("utf-8-sig") if decodes else content)
+    finally:
+        process.stdin.close()
+        process.stdout.close()
+        process.wait()
@@ -0,0 +1,123 @@
+"""
+Beautifying many documents read as lines of JSON, so that one process serves any number of them.
+
+Each request is a line {"id": ..., "source": ..., "options": {...}}, where the optional options
+override the attributes of Options given for all the requests (line_endings by name, as in
+cf-beautify). Each request is answered with a line
+{"id": ..., "output": ...}
+    with the beautified source, or
+{"id": ..., "error": {"message": ..., "line_number": ..., "column": ..., "position": ...,
+                      "fragment": ...}}
+    if the source fails to parse, or
+{"id": ..., "error": {"message": ...}}
+    if the request is invalid, or beautifying fails unexpectedly.
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+from . import beautifier
+from .util import ParserError
+from .version_abstraction import text_class, write_stream
+import copy
+import json
+import numbers
+
+class _InvalidRequest(Exception):
+    pass
+
+def _option_value(name, value, default):
+    "Return the value of option name given as value in a request, see _request_options"
+    if name == "line_endings":
+        if isinstance(value, text_class) and value in beautifier.LINE_ENDINGS:
+            return beautifier.LINE_ENDINGS[value]
+        if value in beautifier.LINE_ENDINGS.values():
+            return value
+        raise _InvalidRequest("Invalid line_endings %s, expected \"windows\", \"unix\" or "
+                              "\"detect\"" % json.dumps(value))
+    if isinstance(default, bool):
+        if not isinstance(value, bool):
+            raise _InvalidRequest("Invalid %s %s, expected a boolean" % (name, json.dumps(value)))
+    elif isinstance(default, numbers.Integral):
+        if not isinstance(value, numbers.Integral) or isinstance(value, bool) or value < 1:
+            raise _InvalidRequest("Invalid %s %s, expected a positive integer"
+                                  % (name, json.dumps(value)))
+    return value
+
+def _request_options(overrides, options):
+    """
+    Return copy of options with the attributes in overrides, each of the type of its default.
+    line_endings is given by name as in cf-beautify ("windows", "unix" or "detect"), or as the line
+    endings themselves.
+    """
+    if not isinstance(overrides, dict):
+        raise _InvalidRequest("options is not an object")
+    defaults = vars(beautifier.Options())
+    options = copy.copy(options)
+    for name, value in overrides.items():
+        if not name in defaults:
+            raise _InvalidRequest("Unknown option '%s'" % name)
+        setattr(options, name, _option_value(name, value, defaults[name]))
+    return options
+
+def response(line, options):
+    "Return the response (as a dict) to the request line"
+    request_id = None
+    try:
+        try:
+            request = json.loads(line)
+        except ValueError as error:
+            raise _InvalidRequest("Invalid JSON: %s" % error)
+        if not isinstance(request, dict) or not "source" in request:
+            raise _InvalidRequest("Request has no source")
+        request_id = request.get("id")
+        if not isinstance(request["source"], text_class):
+            raise _InvalidRequest("source is not a string")
+        options = _request_options(request.get("options", {}), options)
+        return { "id": request_id,
+                 "output": beautifier.beautified_string(request["source"], options) }
+    except ParserError as error:
+        return { "id": request_id,
+                 "error": { "message": str(error),
+                            "line_number": error.line_number,
+                            "column": error.column,
+                            "position": error.position,
+                            "fragment": error.fragment } }
+    except _InvalidRequest as error:
+        return { "id": request_id, "error": { "message": str(error) } }
+    except Exception as error:
+        # A bug in the beautifier fails only the request, not the rest of them
+        return { "id": request_id,
+                 "error": { "message": "Unexpected error: %s: %s" % (type(error).__name__,
+                                                                     error) } }
+
+def _response_in_worker(line_and_options):
+    return response(*line_and_options)
+
+def responses(lines, options, jobs = 1, in_order = True):
+    """
+    Yield the response to each request line, skipping the empty lines. With more than one job,
+    the requests are beautified in a pool of worker processes, and unless in_order, each response
+    is yielded as soon as it is ready.
+    """
+    lines = (line for line in lines if line.strip())
+    if jobs <= 1:
+        for line in lines:
+            yield response(line, options)
+        return
+    from . import batch
+    pool = batch.worker_pool(jobs)
+    try:
+        # One request at a time, as a client may wait for a response before sending more requests
+        beautified = pool.imap if in_order else pool.imap_unordered
+        for result in beautified(_response_in_worker, ((line, options) for line in lines)):
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def serve(input_stream, output_stream, options, jobs = 1, in_order = True):
+    "Answer the requests read from input_stream until its end, see responses"
+    for result in responses(input_stream, options, jobs, in_order):
+        write_stream(output_stream, json.dumps(result) + "\n")
+        output_stream.flush()
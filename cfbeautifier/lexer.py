@@ -1,7 +1,6 @@
 from __future__ import absolute_import
 from __future__ import unicode_literals
 from .util import ParserError
-from .ply import lex
 
 t_ARROW = r"->"
 t_ASSIGN = r"=>"
@@ -63,7 +62,48 @@ tokens = ([token for token in [id[2:] for id in globals().keys() if id.startswit
                if token.upper() == token] +
            list(keywords.values()))
 
+_master_lexer = None
+
 def lexer():
-    the_lex = lex.lex()
+    """
+    Return a new lexer. The lexer is built on first use (importing ply and compiling the rules
+    takes time), and cloned after that.
+    """
+    global _master_lexer
+    if not _master_lexer:
+        from .ply import lex
+        _master_lexer = lex.lex()
+    the_lex = _master_lexer.clone()
     the_lex.comments = []
     return the_lex
+
+def all_tokens(string):
+    "Return (tokens, comments) pair of lists of the string's tokens"
+    the_lex = lexer()
+    the_lex.input(string)
+    return (list(iter(the_lex.token, None)), the_lex.comments)
+
+def top_level_blocks(tokens):
+    """
+    Return (index of first token, index of last token) pair of each top level bundle and body in
+    tokens (not including comments), by matching the braces. An unterminated block ends at the
+    last token.
+    """
+    blocks = []
+    brace_depth = 0
+    start_index = None # of the current block
+    for index, token in enumerate(tokens):
+        if start_index == None:
+            if token.type in ["BUNDLE", "BODY"]:
+                start_index = index
+        elif token.type == "OPEN_BRACE":
+            brace_depth += 1
+        elif token.type == "CLOSE_BRACE":
+            brace_depth -= 1
+            if brace_depth == 0:
+                blocks.append((start_index, index))
+                start_index = None
+    if start_index != None:
+        blocks.append((start_index, len(tokens) - 1))
+    return blocks
+
@@ -0,0 +1,119 @@
+"""
+Limits on the time and memory taken to beautify one file, so that a pathological file (for
+example a huge list that is rendered many ways over) cannot hang or exhaust a batch run.
+
+The limits are checked on SIGALRM, and the work is interrupted by raising an exception from the
+signal handler, between any two Python operations, so the block should not write anything that
+must not be left half done. The limits only apply in the main thread of a process, on systems with
+the signal, and the memory limit only where the resident memory of the process can be read from
+/proc/self/statm, that is on Linux. The memory is checked every
+CHECK_INTERVAL seconds, so it may grow over the limit a little before the work is interrupted.
+(Capping the address space instead would make allocations fail anywhere, including inside the
+interpreter, which may then fail in ways it does not recover from.)
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+import os
+import time
+# signal is imported on first use, as there are no limits by default
+
+CHECK_INTERVAL = 0.05
+
+class LimitExceeded(Exception):
+    """
+    Beautifying took more time or memory than allowed. phase is what was being done: "parsing",
+    "rendering" or "beautifying" if not known.
+    """
+    def __init__(self, kind, description, phase, function):
+        self.phase = phase
+        Exception.__init__(self, "Too %s: %s while %s (in %s)" % (kind, description, phase,
+                                                                 function))
+
+_PACKAGE_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+_PHASES_BY_MODULE = { "lexer": "parsing",
+                      "parser": "parsing",
+                      "lex": "parsing",
+                      "yacc": "parsing",
+                      "structure": "rendering" }
+
+def _exceeded(kind, description, frames):
+    """
+    Return LimitExceeded, with the phase and the function of the innermost frame of the beautifier
+    in frames (innermost first)
+    """
+    phase = None
+    function = None
+    for frame in frames:
+        path = os.path.abspath(frame.f_code.co_filename)
+        if not path.startswith(_PACKAGE_DIRECTORY + os.sep):
+            continue
+        module = os.path.splitext(os.path.basename(path))[0]
+        # Neither the functions of PLY nor special methods tell much
+        if (function == None and not module in ["lex", "yacc"]
+                and not frame.f_code.co_name.startswith("__")):
+            function = module + "." + frame.f_code.co_name
+        phase = phase or _PHASES_BY_MODULE.get(module)
+        if phase and function:
+            break
+    return LimitExceeded(kind, description, phase or "beautifying", function or "?")
+
+def _outward_frames(frame):
+    while frame:
+        yield frame
+        frame = frame.f_back
+
+def _resident_bytes():
+    "Return the resident memory of this process, or None if cannot read it"
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (IOError, OSError, ValueError, AttributeError):
+        return None
+
+class _Limits(object):
+    "See limited"
+    def __init__(self, seconds, megabytes):
+        self.seconds = seconds
+        self.megabytes = megabytes
+        self.previous_handler = None
+
+    def _check(self, signal_number, frame):
+        if self.max_bytes and self.max_bytes < (_resident_bytes() or 0):
+            raise _exceeded("large", "over %d MB" % self.megabytes, _outward_frames(frame))
+        if self.seconds and self.deadline <= time.time():
+            raise _exceeded("slow", "over %g s" % self.seconds, _outward_frames(frame))
+
+    def __enter__(self):
+        import signal
+        base_bytes = self.megabytes and _resident_bytes()
+        self.max_bytes = base_bytes and base_bytes + self.megabytes * 1024 * 1024
+        self.deadline = self.seconds and time.time() + self.seconds
+        if not self.max_bytes and not self.seconds or not hasattr(signal, "setitimer"):
+            return self
+        try:
+            # None if the handler was not set from Python
+            self.previous_handler = signal.signal(signal.SIGALRM, self._check) or signal.SIG_DFL
+        except ValueError: # Not in the main thread
+            return self
+        interval = CHECK_INTERVAL if self.max_bytes else self.seconds
+        signal.setitimer(signal.ITIMER_REAL, min(interval, self.seconds or interval), interval)
+        return self
+
+    def __exit__(self, exception_type, exception, traceback):
+        if self.previous_handler != None:
+            import signal
+            try:
+                signal.setitimer(signal.ITIMER_REAL, 0)
+            finally:
+                signal.signal(signal.SIGALRM, self.previous_handler)
+        return False
+
+def limited(seconds = None, megabytes = None):
+    """
+    Return a context manager that raises LimitExceeded in the block, if it runs for longer than
+    seconds, or grows the resident memory by more than megabytes. None for no limit. See the module
+    docstring for where the limits apply.
+    """
+    return _Limits(seconds, megabytes)
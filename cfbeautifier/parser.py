@@ -6,10 +6,10 @@ from .util import ParserError
 from . import structure
 from . import util
 from .version_abstraction import text_class
-from .ply import yacc
 import os
 import re
 import sys
+import threading
 
 tokens = lexer.tokens
 
@@ -226,8 +226,6 @@ def declare_grammar():
     for line in grammar:
         declare_grammar_function(*line)
 
-declare_grammar()
-
 def p_error(p):
     if p:
         raise ParserError(p.value, p.lineno, p.lexer.lexdata, p.lexpos)
@@ -236,8 +234,25 @@ def p_error(p):
         # does not give the input string.
         raise ParserError("End of file", 0, "", 0)
 
-yacc.yacc(debug = False,
-          picklefile = os.path.join(os.path.dirname(os.path.realpath(__file__)), "/tmp/parsetab.pickle"))
+_parser = None
+# The parser (as well as the lexer module) keeps state of the parse in module variables, so one
+# parse at a time
+parse_lock = threading.RLock()
+
+def parser():
+    """
+    Return the parser. The grammar is declared and the parser tables are built (or loaded) on first
+    use, so that importing this module is cheap.
+    """
+    global _parser
+    with parse_lock:
+        if not _parser:
+            from .ply import yacc
+            declare_grammar()
+            _parser = yacc.yacc(debug = False,
+                                picklefile = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                                          "/tmp/parsetab.pickle"))
+        return _parser
 
 ######
 
@@ -321,13 +336,14 @@ def specification_from_string(string, options):
             if node:
                 node.preceded_by_empty_line = True
 
-    cf_lexer = lexer.lexer()
-    lexer.last_end_pos = 0
-    lexer.last_end_line_number = 0
-    lexer.parse_index = 0
-    cf_lexer.input(string)
+    with parse_lock:
+        cf_lexer = lexer.lexer()
+        lexer.last_end_pos = 0
+        lexer.last_end_line_number = 0
+        lexer.parse_index = 0
+        cf_lexer.input(string)
 
-    specification = yacc.parse(string, lexer = cf_lexer, tracking = True)
+        specification = parser().parse(string, lexer = cf_lexer, tracking = True)
     nodes = specification.descendants()
     empty_line_numbers = line_numbers_of_empty_lines(string)
     comments = comments(cf_lexer.comments, empty_line_numbers, cf_lexer.lineno)
@@ -338,3 +354,25 @@ def specification_from_string(string, options):
         node.after_parse(options)
 
     return specification
+
+def top_level_block_lines(string):
+    """
+    Return (start_line_number, end_line_number) pair for each top level bundle and body, in order,
+    by lexing (not parsing) the string. The start line includes the comment lines immediately
+    before the block, as those comments belong to the block. Raises ParserError if fails to lex.
+    """
+    tokens, comment_tokens = lexer.all_tokens(string)
+    spans = [(tokens[first].lineno, tokens[last].lineno)
+             for first, last in lexer.top_level_blocks(tokens)]
+
+    # Lines with a comment that is neither inside a block nor at the end of a block's last line
+    top_level_comment_lines = set(map(lambda comment: comment.lineno, comment_tokens))
+    for start_line_number, end_line_number in spans:
+        top_level_comment_lines.difference_update(range(start_line_number, end_line_number + 1))
+
+    def with_comment_lines(span):
+        start_line_number, end_line_number = span
+        while start_line_number - 1 in top_level_comment_lines:
+            start_line_number -= 1
+        return (start_line_number, end_line_number)
+    return list(map(with_comment_lines, spans))
@@ -0,0 +1,134 @@
+"""
+Splitting a run into shards, so that the files can be beautified or checked on several machines,
+and merging the results of the shards into one.
+
+A shard is given as (index, count), with index from 1 to count. The files are assigned to shards
+by their paths relative to their input directories (and sizes) only, so that each machine finds
+the same assignment for the same files without talking to the others, wherever the files are
+checked out and however the input directories are given. The results file of a shard is JSON:
+{"shard": [index, count] or null, "mode": ..., "failed": ...,
+ "files": [{"path": ..., "status": ..., "error": ..., "output": ...}, ...]}
+with the statuses of batch.FileResult, and the output only for the diffs of unformatted files.
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+from .util import atomically_written
+from .version_abstraction import string_from_file, write_stream
+import json
+import os
+import zlib
+
+class ShardError(Exception):
+    "The results cannot be read or merged"
+
+def parsed(string):
+    "Return (index, count) of shard given as 'K/N'. Raises ValueError if invalid."
+    try:
+        index, count = map(int, string.split("/"))
+    except ValueError:
+        raise ValueError("Invalid shard '%s', expected K/N" % string)
+    if not 1 <= index <= count:
+        raise ValueError("Invalid shard '%s', K must be from 1 to N" % string)
+    return (index, count)
+
+def _path_hash(relative_path):
+    # Stable across processes, machines and platforms, unlike hash()
+    path = os.path.normpath(relative_path).replace(os.sep, "/")
+    return zlib.crc32(path.encode("utf-8")) & 0xffffffff
+
+def hashed(items, index, count):
+    """
+    Yield the items ((path, path relative to its input directory) tuples) that are in the shard by
+    the hash of their relative path. items may be an iterator, that is consumed as the items are
+    yielded.
+    """
+    for item in items:
+        if _path_hash(item[1]) % count == index - 1:
+            yield item
+
+def size_balanced(items, index, count):
+    """
+    Return the items ((path, relative path) tuples) that are in the shard, when the items are split
+    into shards of about equal total size of the files: the largest file first, each into the
+    shard with the least bytes so far.
+    """
+    def size(item):
+        try:
+            return os.path.getsize(item[0])
+        except OSError: # Reported when beautified
+            return 0
+    items = list(items)
+    sizes = list(map(size, items))
+    shard_bytes = [0] * count
+    shard_items = [[] for shard in range(count)]
+    # Ties broken by relative path, and the lowest shard, so that the assignment is the same on
+    # every run
+    for position in sorted(range(len(items)), key = lambda position: (-sizes[position],
+                                                                      items[position][1])):
+        shard = shard_bytes.index(min(shard_bytes))
+        shard_bytes[shard] += sizes[position]
+        shard_items[shard].append(position)
+    # In the order found
+    return [items[position] for position in sorted(shard_items[index - 1])]
+
+def record(result):
+    "Return the record of batch.FileResult for the results file"
+    return { "path": result.path,
+             "status": result.status,
+             "error": result.error,
+             "output": result.output if result.status == "unformatted" else None }
+
+def write_results(path, shard, mode, records, failed):
+    "Write the results file of the shard ((index, count) or None) with the records of the files"
+    with atomically_written(path) as file:
+        write_stream(file, json.dumps({ "shard": shard,
+                                        "mode": mode,
+                                        "failed": failed,
+                                        "files": records }) + "\n")
+
+def _loaded(path):
+    try:
+        results = json.loads(string_from_file(path))
+    except (IOError, OSError, ValueError) as error:
+        raise ShardError("Cannot read %s: %s" % (path, error))
+    if (not isinstance(results, dict)
+            or not set(["shard", "mode", "failed", "files"]) <= set(results)):
+        raise ShardError("%s is not a results file" % path)
+    return results
+
+def merged_results(paths):
+    """
+    Return the results merged from the results files at paths, in the order of the shards. Raises
+    ShardError if a file cannot be read, or the files are not the results of each shard of a run
+    exactly once.
+    """
+    all_results = list(map(_loaded, paths))
+    if len(set(results["mode"] for results in all_results)) != 1:
+        raise ShardError("The results are of different modes")
+    shards = [results["shard"] and tuple(results["shard"]) for results in all_results]
+    if any(shards):
+        if not all(shards):
+            raise ShardError("Cannot merge results of shards with results of a whole run")
+        counts = set(count for index, count in shards)
+        if len(counts) != 1:
+            raise ShardError("The results are of different numbers of shards")
+        count = counts.pop()
+        for shard in set(shards):
+            if 1 < shards.count(shard):
+                raise ShardError("The results of shard %d/%d are given more than once" % shard)
+        missing = [index for index in range(1, count + 1) if not (index, count) in shards]
+        if missing:
+            raise ShardError("Missing the results of shards %s"
+                             % ", ".join("%d/%d" % (index, count) for index in missing))
+        all_results.sort(key = lambda results: results["shard"])
+    records = [entry for results in all_results for entry in results["files"]]
+    seen_paths = set()
+    for entry in records:
+        if entry["path"] in seen_paths:
+            raise ShardError("%s is in the results more than once" % entry["path"])
+        seen_paths.add(entry["path"])
+    return { "shard": None,
+             "mode": all_results[0]["mode"],
+             "failed": any(results["failed"] for results in all_results),
+             "files": records }
@@ -2,7 +2,7 @@ from __future__ import absolute_import
 from __future__ import print_function
 from __future__ import unicode_literals
 from .color import Color
-from functools import reduce
+from collections import namedtuple
 from itertools import chain
 import copy
 import re
@@ -42,11 +42,14 @@ def isinstance_fn(klass):
     fn.__name__ = str("isinstance_" + klass.__name__) # str for Python 2
     return fn
 
-class Line(object):
-    def __init__(self, string, indent = None, end_comments = []):
-        self.string = string
-        self.indent = indent
-        self.end_comments = end_comments
+class Line(namedtuple("Line", ["string", "indent", "end_comments"])):
+    """
+    Immutable, so that the same Line may be shared between line lists (such as the templates in
+    list args) without copying
+    """
+    __slots__ = ()
+    def __new__(cls, string, indent = None, end_comments = ()):
+        return tuple.__new__(cls, (string, indent, tuple(end_comments)))
     def length(self):
         # TODO need to find first line break in the string, but in a fast way. Could remember this perhaps
         # from parsing.
@@ -55,30 +58,52 @@ class Line(object):
         return Line(self.string + line.string,
                     indent = self.indent if self.indent != None else line.indent,
                     end_comments = self.end_comments + line.end_comments)
+    def indented(self, depth):
+        "Return the line with depth added to its indent"
+        return tuple.__new__(Line, (self.string, (self.indent or 0) + depth, self.end_comments))
     def __eq__(self, line):
-        return isinstance(line, self.__class__) and self.__dict__ == line.__dict__
+        return isinstance(line, self.__class__) and tuple.__eq__(self, line)
     def __ne__(self, line):
         return not self.__eq__(line)
+    def __hash__(self):
+        return tuple.__hash__(self)
     def __repr__(self):
         return 'Line("%s", %s)' % (self.string, str(self.indent))
 
-class Options(object):
+class Options(namedtuple("Options", ["beautifier_options",
+                                     "page_width",
+                                     "indent",
+                                     "ancestor_indent",
+                                     # Whether there may be a line break in constraint
+                                     # (type => value) before value
+                                     "may_line_break_constraint",
+                                     # if True or False, overrides Node
+                                     "respects_preceding_empty_line",
+                                     # If True, () in empty argument list may be removed
+                                     # If False, function call without () is a syntax error
+                                     "allow_braceless_argument_list",
+                                     # Shared by all the contexts derived from this one
+                                     "layout_cache"])):
+    """
+    Immutable layout context given to the lines functions. Children get their own (cheap) context
+    via child(). The beautifier options are held by reference, and their attributes may be read
+    through the context (e.g., options.line_endings).
+    """
+    __slots__ = ()
     DEFAULT_RESPECTS_PRECEDING_EMPTY_LINE = None
-    def __init__(self, beautifier_options):
-        # Copy properties from beautifier_options
-        for attr in filter(lambda attr: not attr.startswith("__"), dir(beautifier_options)):
-            value = getattr(beautifier_options, attr)
-            if not hasattr(value, '__call__'):
-                setattr(self, attr, value)
-        self.indent = 0
-        self.ancestor_indent = 0
-        # Whether there may be a line break in constraint (type => value) before value
-        self.may_line_break_constraint = True
-        # if True or False, overrides Node
-        self.respects_preceding_empty_line = Options.DEFAULT_RESPECTS_PRECEDING_EMPTY_LINE
-        # If True, () in empty argument list may be removed
-        # If False, function call without () is a syntax error
-        self.allow_braceless_argument_list = True
+    def __new__(cls, beautifier_options):
+        return tuple.__new__(cls, (beautifier_options,
+                                   beautifier_options.page_width,
+                                   0,
+                                   0,
+                                   True,
+                                   Options.DEFAULT_RESPECTS_PRECEDING_EMPTY_LINE,
+                                   True,
+                                   LayoutCache()))
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        return getattr(self.beautifier_options, name)
     def depth(self):
         return self.indent + self.ancestor_indent
     def tabs(self, count):
@@ -86,28 +111,126 @@ class Options(object):
     def available_width(self):
         return self.page_width - self.depth()
     def indent_lines(self, lines):
+        "Replaces all but the first line in the (mutable) list with lines indented to this depth"
         if lines:
             depth = self.indent
-            for line in lines[1:]:
-                line.indent = (line.indent or 0) + depth
+            lines[1:] = [line.indented(depth) for line in lines[1:]]
+    def modified(self, **kwargs):
+        "Return a copy of the context with the given fields replaced"
+        return self._replace(**kwargs)
     def child(self, *line_arrays_and_char_counts, **kwargs):
         # Cannot have explicit keyword args after splat args
+        # Don't inherit the respect for empty line; it is used by list for inlining
         respects_preceding_empty_line = kwargs.get("respects_preceding_empty_line",
                                                    Options.DEFAULT_RESPECTS_PRECEDING_EMPTY_LINE)
 
-        def added_depth():
-            def depth(lines_or_char_count):
-                if isinstance(lines_or_char_count, list):
-                    return lines_or_char_count[-1].length()
-                else:
-                    return lines_or_char_count
-            return sum(map(depth, line_arrays_and_char_counts))
-        child = copy.copy(self)
-        child.ancestor_indent += self.indent
-        child.indent = added_depth()
-        # Don't inherit the respect for empty line; it is used by list for inlining
-        child.respects_preceding_empty_line = respects_preceding_empty_line
-        return child
+        added_depth = 0
+        for lines_or_char_count in line_arrays_and_char_counts:
+            if isinstance(lines_or_char_count, list):
+                added_depth += lines_or_char_count[-1].length()
+            else:
+                added_depth += lines_or_char_count
+        return tuple.__new__(Options, (self.beautifier_options,
+                                       self.page_width,
+                                       added_depth,
+                                       self.ancestor_indent + self.indent,
+                                       self.may_line_break_constraint,
+                                       respects_preceding_empty_line,
+                                       self.allow_braceless_argument_list,
+                                       self.layout_cache))
+
+class LayoutCache(object):
+    """
+    Lines of subtrees (nodes with is_layout_cached) by the content of the subtree and the layout
+    context, so that a subtree that is repeated in the specification is laid out only once.
+    Content is hash-consed: each distinct content gets a small integer id, and the content of a
+    parent refers to the ids of its children.
+    """
+    def __init__(self):
+        self.lines_by_key = {}
+        self.id_by_content = {}
+        self.content_id_by_node = {}
+        self.hits = 0
+        self.misses = 0
+    def content_id(self, node):
+        "Return id of the content of the node's subtree, or None if it cannot be laid out by content"
+        try:
+            return self.content_id_by_node[node]
+        except KeyError:
+            content = None if node.comments else node.content(self)
+            if content is None:
+                content_id = None
+            else:
+                content = (node.__class__,
+                           node.preceded_by_empty_line,
+                           node.respects_preceding_empty_line,
+                           content)
+                content_id = self.id_by_content.setdefault(content, len(self.id_by_content))
+            self.content_id_by_node[node] = content_id
+            return content_id
+    def lines(self, node, options):
+        """
+        Return node._lines(options), laid out only if the same content has not been laid out
+        in an equivalent context before. The returned list must not be modified.
+        """
+        content_id = self.content_id(node)
+        if content_id is None:
+            return node._lines(options)
+        # The parts of the context that _lines of the cached nodes may depend on. The indent
+        # is applied by Node.lines, so only the total depth matters.
+        key = (content_id,
+               options.indent + options.ancestor_indent,
+               options.ancestor_indent == 0,
+               options.page_width,
+               options.may_line_break_constraint,
+               options.allow_braceless_argument_list)
+        lines = self.lines_by_key.get(key)
+        if lines is None:
+            self.misses += 1
+            lines = self.lines_by_key[key] = node._lines(options)
+        else:
+            self.hits += 1
+        return lines
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups else 0.0
+
+def string_from_line(line):
+    string = line.string + "".join(map(lambda line: line.string, line.end_comments))
+    # No indent for empty lines
+    if string and line.indent:
+        return " " * line.indent + string
+    return string
+
+class BufferedLineWriter(object):
+    """
+    Writes Lines into a stream, separated by line endings. Collects the strings in memory until
+    there are buffer_size characters, so that the stream is not written one line at a time.
+    """
+    def __init__(self, stream, line_endings, buffer_size = 64 * 1024):
+        self.stream = stream
+        self.line_endings = line_endings
+        self.buffer_size = buffer_size
+        self.is_first_line = True
+        self.chunks = []
+        self.buffered_size = 0
+    def write_lines(self, lines):
+        for line in lines:
+            if self.is_first_line:
+                self.is_first_line = False
+            else:
+                self._append(self.line_endings)
+            self._append(string_from_line(line))
+    def _append(self, string):
+        self.chunks.append(string)
+        self.buffered_size += len(string)
+        if self.buffer_size <= self.buffered_size:
+            self.flush()
+    def flush(self):
+        if self.chunks:
+            self.stream.write("".join(self.chunks))
+            self.chunks = []
+            self.buffered_size = 0
 
 def joined_lines(*line_arrays):
     joined_lines = []
@@ -265,6 +388,11 @@ def first_that_fits(options, lines_fns):
             break
     return lines
 
+def content_of_children(layout_cache, children):
+    "Return tuple of the content ids of the children, or None if any of them has no content"
+    ids = tuple(map(layout_cache.content_id, children))
+    return None if None in ids else ids
+
 # ----- Node Classes ------------------------------------------------------------------------------
 
 class Node(object):
@@ -288,6 +416,15 @@ class Node(object):
         self.consumes_preceding_empty_line = True
     def after_parse(self, options):
         pass
+    # Whether the lines of the node are looked up from the layout cache by the content
+    is_layout_cached = False
+    def content(self, layout_cache):
+        """
+        Return hashable content of the subtree (that determines its lines together with the
+        layout context), with the children given as ids from layout_cache.content_id.
+        None means that the node is never laid out by content.
+        """
+        return None
     def _node_names(self):
         return filter(lambda x: x.startswith("p_"), dir(self))
     def __getitem__(self, name):
@@ -357,9 +494,9 @@ class Node(object):
         return [comment for comment in self.comments if comment != tail_comment]
     def lines(self, options):
         def merged_comment(comments):
-            merged_comment = copy.deepcopy(comments[0])
+            merged_comment = comments[0]
             for comment in comments[1:]:
-                merged_comment.append_comment(comment)
+                merged_comment = merged_comment.appended(comment)
             return merged_comment
         lines = self._preceding_empty_line(options)
         if self.comments: # optimisation, saves 30% of rendering time
@@ -384,12 +521,16 @@ class Node(object):
                 line_comment_lines = []
 
             lines += (line_comment_lines
-                      + joined_lines(self._lines(options),
+                      + joined_lines(self._laid_out_lines(options),
                                      [Line("", end_comments = tail_comment_lines)]))
         else:
-            lines += self._lines(options)
+            lines += self._laid_out_lines(options)
         options.indent_lines(lines)
         return lines
+    def _laid_out_lines(self, options):
+        if self.is_layout_cached:
+            return options.layout_cache.lines(self, options)
+        return self._lines(options)
     def _preceding_empty_line(self, options):
         respects_empty_line = (options.respects_preceding_empty_line
                                   if options.respects_preceding_empty_line != None
@@ -398,14 +539,16 @@ class Node(object):
     def inspect(self):
         return re.sub(r"\n", " | ", str(self))
     def to_string(self, options):
-        def string_from_line(line):
-            string = line.string + "".join(map(lambda line: line.string, line.end_comments))
-            # No indent for empty lines
-            if string and line.indent:
-                return " " * line.indent + string
-            return string
         line_endings = options.line_endings or "\n"
         return line_endings.join(map(string_from_line, self.lines(options)))
+    def write(self, stream, options, buffer_size = 64 * 1024):
+        """
+        Write the same text as to_string would return into stream (any object with a write
+        method taking a text string), buffer_size characters at a time
+        """
+        writer = BufferedLineWriter(stream, options.line_endings or "\n", buffer_size)
+        writer.write_lines(self.lines(options))
+        writer.flush()
     def __repr__(self):
         return self.__class__.__name__
 
@@ -469,10 +612,16 @@ class Comment(Node):
         self.text_lines.insert(0, line)
         self.position.start_line_number = position.start_line_number
         self.position.start_pos = position.start_pos
-    def append_comment(self, comment):
-        self.text_lines.extend(comment.text_lines)
-        self.position.end_line_number = comment.position.end_line_number
-        self.position.end_pos = comment.position.end_pos
+    def appended(self, comment):
+        "Return a new comment with the lines of the given comment appended. Neither is modified."
+        merged = copy.copy(self)
+        merged.text_lines = self.text_lines + comment.text_lines
+        merged.position = Position(self.position.start_line_number,
+                                   comment.position.end_line_number,
+                                   self.position.start_pos,
+                                   comment.position.end_pos,
+                                   self.position.parse_index)
+        return merged
     def _lines(self, options):
         # text without starting #
         def text_for_line(line):
@@ -662,8 +811,7 @@ class Constraint(Node):
         # cf-promises could be asked for the full body list, which might be used in the future)
         if self["type"].name in NON_BUNDLE_OR_BODY_CONSTRAINT_TYPES:
             # Disable removal of braces from function args, if empty arg list
-            value_options_base = copy.copy(options)
-            value_options_base.allow_braceless_argument_list = False
+            value_options_base = options.modified(allow_braceless_argument_list = False)
         else:
             # Bundle and body arglist may be without braces
             value_options_base = options
@@ -692,16 +840,18 @@ class Selection(Constraint):
     def _lines(self, options):
         # Body constraint value may currently not be a bundle or body call, so assume it may be
         # a function call, i.e., disable removal of braces from empty arglist
-        options = copy.deepcopy(options)
-        options.allow_braceless_argument_list = False
+        options = options.modified(allow_braceless_argument_list = False)
 
         return joined_lines(super(Selection, self)._lines(options), [Line(";")])
 
 class Function(Node):
+    is_layout_cached = True
     def __init__(self, position, name, args):
         super(Function, self).__init__(position)
         self["name"] = name
         self["args"] = args
+    def content(self, layout_cache):
+        return content_of_children(layout_cache, [self["name"], self["args"]])
     def _lines(self, options):
         name_lines = self["name"].lines(options.child())
         return joined_lines(name_lines, self["args"].lines(options.child(name_lines)))
@@ -710,6 +860,8 @@ class String(Node):
     def __init__(self, position, name):
         super(String, self).__init__(position)
         self.name = name
+    def content(self, layout_cache):
+        return self.name
     def _lines(self, options):
         return [Line(self.name, 0)]
     def add_comments(self, comments, parents):
@@ -780,75 +932,117 @@ class ListBase(Node):
         self.items = new_items
     def is_standalone_comment_for_node(self, item, comment):
         return False
+    def content(self, layout_cache):
+        # The braces are rendered by the list formatter, but may have comments
+        for brace in filter(None, [self["open_brace"], self["close_brace"]]):
+            if layout_cache.content_id(brace) == None:
+                return None
+        return content_of_children(layout_cache, self.items)
     def _lines(self, options):
-        return first_that_fits(options, map(lambda list_arg:
-                                                lambda options: self._format_items(options, **list_arg),
-                                            self.list_args(options)))
-    def _format_items(self, options,
-                      join_by = None,
-                      prefix_by = None,
-                      postfix_by = None,
-                      empty = [Line("")],
-                      start = None,
-                      end = None,
-                      terminator = "",
-                      end_terminator = "",
-                      respects_preceding_empty_line_fn = lambda is_first: None, # None means ignored
-                      depth_fn = lambda list, node: 0):
-        join_by, prefix_by, postfix_by, empty, start, end = (
-            map(copy.deepcopy, [join_by, prefix_by, postfix_by, empty, start, end]))
-
-        def child_lines(node, terminator, index):
-            # Avoid commas etc at the end of standalone comments
-            if isinstance(node, Comment):
-                terminator = ""
+        return first_that_fits(options, map(lambda formatter:
+                                                lambda options: formatter.format(self, options),
+                                            self.list_formatters(options)))
 
+class ListFormatter(object):
+    """
+    Formats the items of a list. Created from a list args dict (such as LIST_ARGS), normally
+    once at import, so that the arguments are unpacked and the Lines that do not depend on the
+    items are built only once.
+    """
+    def __init__(self,
+                 join_by = None,
+                 prefix_by = None,
+                 postfix_by = None,
+                 empty = [Line("")],
+                 start = None,
+                 end = None,
+                 terminator = "",
+                 end_terminator = "",
+                 respects_preceding_empty_line_fn = lambda is_first: None, # None means ignored
+                 # Either depth (constant) or depth_fn (called for each item) may be given
+                 depth = 0,
+                 depth_fn = None):
+        self.join_by = join_by
+        self.prefix_by = prefix_by
+        self.postfix_by = postfix_by
+        self.empty = empty
+        self.start = start
+        self.end = end
+        self.terminator_lines = [Line(terminator)]
+        self.end_terminator_lines = [Line(end_terminator)]
+        # respects_preceding_empty_line_fn may only depend on whether the item is the first one
+        self.first_respects_preceding_empty_line = respects_preceding_empty_line_fn(True)
+        self.rest_respect_preceding_empty_line = respects_preceding_empty_line_fn(False)
+        self.depth = depth
+        self.depth_lines = [Line("", depth)]
+        self.depth_fn = depth_fn
+    def format(self, list_node, options):
+        items = list_node.items
+        if not items:
+            # The Lines are immutable, but the list is not
+            return list(self.empty)
+        last_index = len(items) - 1
+        # joined_lines is associative, so the items may be joined in a single call
+        line_arrays = [self.start]
+        for index, node in enumerate(items):
             is_first = index == 0
+            if is_first:
+                respects_preceding_empty_line = self.first_respects_preceding_empty_line
+            else:
+                line_arrays.append(self.join_by)
+                respects_preceding_empty_line = self.rest_respect_preceding_empty_line
+                if isinstance(node, Promise) or isinstance(node, Class):
+                    node.preceded_by_empty_line = True
+
+            if self.depth_fn:
+                depth = self.depth_fn(list_node, node)
+                depth_lines = [Line("", depth)]
+            else:
+                depth = self.depth
+                depth_lines = self.depth_lines
 
-            if (isinstance(node, Promise) or isinstance(node, Class)) and not is_first:
-                node.preceded_by_empty_line = True
+            # Avoid commas etc at the end of standalone comments
+            if isinstance(node, Comment):
+                terminator_lines = None
+            elif index == last_index:
+                terminator_lines = self.end_terminator_lines
+            else:
+                terminator_lines = self.terminator_lines
 
-            depth = depth_fn(self, node)
             child_options = options.child(depth,
                                           respects_preceding_empty_line =
-                                              respects_preceding_empty_line_fn(is_first))
-            return joined_lines([Line("", depth)], node.lines(child_options), [Line(terminator)])
-        if not self.items:
-            return empty
-        else:
-            terminators = [terminator] * (len(self.items) - 1) + [end_terminator]
-
-            # Want to say map(lambda (index, (terminator, node)) but cannot in Python 3
-            child_line_arrays = list(map(lambda idx_and_terminator_node_pair:
-                                             joined_lines(prefix_by,
-                                                          child_lines(idx_and_terminator_node_pair[1][1],
-                                                                      idx_and_terminator_node_pair[1][0],
-                                                                      idx_and_terminator_node_pair[0]),
-                                                          postfix_by),
-                                         enumerate(zip(terminators, self.items))))
-            children_lines = reduce(lambda joined, lines: joined_lines(joined, join_by, lines),
-                                     child_line_arrays[1:],
-                                     child_line_arrays[0])
-            return joined_lines(start, children_lines, end)
+                                              respects_preceding_empty_line)
+            line_arrays.extend([self.prefix_by,
+                                depth_lines,
+                                node.lines(child_options),
+                                terminator_lines,
+                                self.postfix_by])
+        line_arrays.append(self.end)
+        return joined_lines(*line_arrays)
+
+def list_formatters(list_args):
+    "Return a list of ListFormatters, one for each list args dict"
+    return [ListFormatter(**args) for args in list_args]
 
 LINE_BREAK = [Line(""), Line("")]
 
 class InlinableList(ListBase):
+    is_layout_cached = True
     def inlinable(self):
         has_comments = find_in_list(lambda node: node.comments or isinstance(node, Comment),
                                     self.items)
         return not has_comments
-    def list_args(self, options):
-        inlined_args, lined_args = self._inlined_and_lined_list_args(options)
+    def list_formatters(self, options):
+        inlined_formatter, lined_formatter = self._inlined_and_lined_list_formatters(options)
         if not self.inlinable():
-            return [lined_args]
+            return [lined_formatter]
         elif  1 < len(self.items): # don't line-break a list with just one element
-            return [lined_args]
+            return [lined_formatter]
         else:
-            return [inlined_args]
-    def _inlined_and_lined_list_args(self, options):
+            return [inlined_formatter]
+    def _inlined_and_lined_list_formatters(self, options):
         """
-        Return a pair of list args, first for inlining the list,
+        Return a pair of list formatters, first for inlining the list,
         and second for having line breaks between elements
         """
         raise RuntimeError("To be implemented by deriving class")
@@ -866,11 +1060,12 @@ LIST_ARGS = ({ "join_by" : [Line(" ")],
                "empty" : [Line("{}")],
                "start" : [Line("{"), Line("")],
                "end" : [Line("}")],
-               "depth_fn" : lambda list, node: 1,
+               "depth" : 1,
                "respects_preceding_empty_line_fn" : lambda is_first: not is_first })
+LIST_FORMATTERS = list_formatters(LIST_ARGS)
 class List(InlinableList):
-    def _inlined_and_lined_list_args(self, options):
-        return LIST_ARGS
+    def _inlined_and_lined_list_formatters(self, options):
+        return LIST_FORMATTERS
 
 ARGUMENT_LIST_ARGS = ({ "join_by" : [Line(" ")],
                         "terminator" : ",",
@@ -881,7 +1076,7 @@ ARGUMENT_LIST_ARGS = ({ "join_by" : [Line(" ")],
                         "end_terminator" : ")",
                         "start" : [Line("(")],
                         # 1 == len("(") })
-                        "depth_fn" : lambda list, node: 1 })
+                        "depth" : 1 })
 
 ARGUMENT_LIST_NO_LINE_BREAK = tuple(map(lambda arg: merged_dicts(arg,
                                                                  { "join_by" : [Line(" ")]}),
@@ -890,24 +1085,45 @@ ARGUMENT_LIST_NO_LINE_BREAK = tuple(map(lambda arg: merged_dicts(arg,
 ARGUMENT_LIST_ARGS_NON_BRACELESS = tuple(map(lambda arg: merged_dicts(arg,
                                                                       { "empty" : [Line("()")] }),
                                          ARGUMENT_LIST_ARGS))
+ARGUMENT_LIST_FORMATTERS = list_formatters(ARGUMENT_LIST_ARGS)
+ARGUMENT_LIST_NO_LINE_BREAK_FORMATTERS = list_formatters(ARGUMENT_LIST_NO_LINE_BREAK)
+ARGUMENT_LIST_NON_BRACELESS_FORMATTERS = list_formatters(ARGUMENT_LIST_ARGS_NON_BRACELESS)
 class ArgumentList(InlinableList):
-    def _inlined_and_lined_list_args(self, options):
+    def _inlined_and_lined_list_formatters(self, options):
         if not options.allow_braceless_argument_list:
-            return ARGUMENT_LIST_ARGS_NON_BRACELESS
+            return ARGUMENT_LIST_NON_BRACELESS_FORMATTERS
         # Do not line break if ArgumentList is from Bundle or Body
         elif options.ancestor_indent == 0:
-            return ARGUMENT_LIST_NO_LINE_BREAK
-        return ARGUMENT_LIST_ARGS
+            return ARGUMENT_LIST_NO_LINE_BREAK_FORMATTERS
+        return ARGUMENT_LIST_FORMATTERS
 
+SPECIFICATION_LIST_ARGS = [{ "join_by" : LINE_BREAK,
+                             "postfix_by" : LINE_BREAK }]
+SPECIFICATION_LIST_FORMATTERS = list_formatters(SPECIFICATION_LIST_ARGS)
 class Specification(ListBase):
-    def list_args(self, options):
-        return [{ "join_by" : LINE_BREAK,
-                  "postfix_by" : LINE_BREAK }]
+    def list_formatters(self, options):
+        return SPECIFICATION_LIST_FORMATTERS
+    def write(self, stream, options, buffer_size = 64 * 1024):
+        """
+        Renders and writes one block (or top level comment) at a time, so that the lines of the
+        whole specification never need to be in memory at the same time. The output is equal to
+        to_string.
+        """
+        if self.comments:
+            # Not expected, as the items adopt all the comments, but the general case handles this
+            return super(Specification, self).write(stream, options, buffer_size)
+        writer = BufferedLineWriter(stream, options.line_endings or "\n", buffer_size)
+        for item in self.items:
+            # Equal to SPECIFICATION_LIST_FORMATTERS: each item followed by an empty line
+            child_options = options.child(0)
+            writer.write_lines(joined_lines([Line("", 0)], item.lines(child_options), [Line("")]))
+            writer.write_lines([Line("")])
+        writer.flush()
 
 def class_list_depth_fn(default_class_tab_depth, class_of_intended_node):
     def class_list_depth(list, node):
         """
-        Tab depth function (for ListBase list_arg) for when list constains Classes and something else.
+        Tab depth function (depth_fn in list args) for when list constains Classes and something else.
         Indents classes by one, and promises by 2. Comments are indented based on their original
         indentation, to appear either as children to classes or promise type
         """
@@ -947,13 +1163,15 @@ PROMISE_TYPE_LIST_ARGS, CLASS_SELECTION_LIST_ARGS = (
                                          "start" : [Line(" {"), Line("")],
                                          "end" : [Line("}")] })],
                                  [{ "join_by" : LINE_BREAK,
-                                    "depth_fn" : lambda list, node: TAB_SIZE },
+                                    "depth" : TAB_SIZE },
                                   { "depth_fn" : class_list_depth_fn(1, Selection),
                                     "respects_preceding_empty_line_fn" :
                                         # Never empty line before the first class or selection
                                         does_not_respect_empty_line_before_first_item }]))
+PROMISE_TYPE_LIST_FORMATTERS = list_formatters(PROMISE_TYPE_LIST_ARGS)
+CLASS_SELECTION_LIST_FORMATTERS = list_formatters(CLASS_SELECTION_LIST_ARGS)
 
-def block_child_list_args(block, options, list_args_base):
+def block_child_list_formatters(block, options, list_args_base, list_formatters_base):
     """
     Helper for bundle element list (PromiseTypeList) and body child list (ClassSelectionList)
     to be able to have comments on the opening brace. Those two classes have a different class
@@ -962,33 +1180,34 @@ def block_child_list_args(block, options, list_args_base):
     options: options as given to lines function
     list_args_base: Either PROMISE_TYPE_LIST_ARGS (if block is PromiseTypeList)
                     or CLASS_SELECTION_LIST_ARGS (if block is ClassSelectionList)
-    Returns either list_args_base as is, or as modified to include the opening brace comments
+    list_formatters_base: The formatters compiled from list_args_base
+    Returns either list_formatters_base as is, or formatters made from list_args_base as modified
+    to include the opening brace comments
     """
     open_brace = block["open_brace"]
     close_brace = block["close_brace"]
-    # Avoid the copy for performance reasons if it is not necessary
     if open_brace.comments or close_brace.comments:
         # This contains unfortunate duplication of PROMISE_TYPE_LIST_ARGS generation logic
-        list_args = copy.deepcopy(list_args_base)
+        brace_args = {}
 
         if open_brace.comments:
             open_brace_lines = [Line("")] + open_brace.lines(options)
-            list_args[0]["start"] = open_brace_lines + [Line("")]
+            brace_args["start"] = open_brace_lines + [Line("")]
             empty_lines = open_brace_lines
         else:
             empty_lines = [Line(" {")]
 
         if close_brace.comments:
             close_brace_lines = close_brace.lines(options)
-            list_args[0]["end"] = close_brace_lines
-            empty_lines.extend(close_brace_lines)
+            brace_args["end"] = close_brace_lines
+            empty_lines = empty_lines + close_brace_lines
         else:
-            empty_lines.append(Line("}"))
+            empty_lines = empty_lines + [Line("}")]
 
-        list_args[0]["empty"] = empty_lines
-        return list_args
+        brace_args["empty"] = empty_lines
+        return list_formatters([merged_dicts(list_args_base[0], brace_args)])
     else:
-        return list_args_base
+        return list_formatters_base
 
 def add_comments_to_block_child_list(block, comments, parents):
     """
@@ -1078,8 +1297,9 @@ class PromiseTypeList(ListBase):
         promise_types, comments = partition(isinstance_fn(PromiseType), items)
         sorted_promise_types = sorted(promise_types, key = promise_index)
         return with_interleaved_comments(sorted_promise_types, items, comments)
-    def list_args(self, options):
-        return block_child_list_args(self, options, PROMISE_TYPE_LIST_ARGS)
+    def list_formatters(self, options):
+        return block_child_list_formatters(self, options,
+                                           PROMISE_TYPE_LIST_ARGS, PROMISE_TYPE_LIST_FORMATTERS)
     def is_standalone_comment_for_node(self, item, comment):
         # The indentation for promise type is 1 * tab size, so assume anything above that belongs
         # to the node
@@ -1103,8 +1323,9 @@ class ClassAndSomethingList(ListBase):
 class ClassSelectionList(ClassAndSomethingList):
     def add_comments(self, comments, parents):
         add_comments_to_block_child_list(self, comments, parents)
-    def list_args(self, options):
-        return block_child_list_args(self, options, CLASS_SELECTION_LIST_ARGS)
+    def list_formatters(self, options):
+        return block_child_list_formatters(self, options,
+                                           CLASS_SELECTION_LIST_ARGS, CLASS_SELECTION_LIST_FORMATTERS)
 
 # Promises are indented as if they are under classes in tree, so deeper
 CLASS_PROMISE_LIST_ARGS = [{ "depth_fn" : class_list_depth_fn(2, Promise),
@@ -1112,18 +1333,20 @@ CLASS_PROMISE_LIST_ARGS = [{ "depth_fn" : class_list_depth_fn(2, Promise),
                              "respects_preceding_empty_line_fn" :
                                 does_not_respect_empty_line_before_first_item,
                              "join_by" : LINE_BREAK }]
+CLASS_PROMISE_LIST_FORMATTERS = list_formatters(CLASS_PROMISE_LIST_ARGS)
 # for Bundle, elements should be PromiseTypes. For Body, they should be Classes or Selections.
 class ClassPromiseList(ClassAndSomethingList):
     def __init__(self, *args):
         super(ClassAndSomethingList, self).__init__(*args)
         self.consumes_preceding_empty_line = False # Github #6
-    def list_args(self, options):
-        return CLASS_PROMISE_LIST_ARGS
+    def list_formatters(self, options):
+        return CLASS_PROMISE_LIST_FORMATTERS
 
 CONSTRAINT_LIST_ARGS = [{ "empty" : [Line(";")],
                           "join_by" : LINE_BREAK,
                           "terminator" : ",",
                           "end_terminator" : ";" }]
+CONSTRAINT_LIST_FORMATTERS = list_formatters(CONSTRAINT_LIST_ARGS)
 class ConstraintList(ListBase):
-    def list_args(self, options):
-        return CONSTRAINT_LIST_ARGS
+    def list_formatters(self, options):
+        return CONSTRAINT_LIST_FORMATTERS
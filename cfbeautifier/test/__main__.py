@@ -8,22 +8,40 @@ this_dir = os.path.realpath(os.path.dirname(os.path.realpath(__file__)))
 beautifier_executable_path = os.path.join(this_dir, "cf-beautifier")
 test_cf_dir = os.path.join(this_dir, "test_cfs")
 
+from .. import archive
+from .. import batch
 from .. import beautifier
+from . import benchmark
+from .. import cache
+from .. import daemon
+from .. import diff
+from .. import edits
+from .. import git
+from .. import jsonl
+from .. import limits
+from .. import shard
+from .. import walk
 from ..color import Color
 from ..version_abstraction import string_from_file
 import random
 from .. import structure
 from ..structure import Line
-from ..util import ParserError
+from ..util import ParserError, atomically_written
+import io
 import re
 import shutil
 import subprocess
+import sys
 import tempfile
 import time
 import unittest
 
 temp_dir = os.path.join(tempfile.gettempdir(), "cfbeautifier_tmp")
 
+# The start up imports take 5-20 ms on a developer machine, and over 50 ms when they build the
+# parser, so this leaves room for slower machines
+STARTUP_IMPORT_TIME_BUDGET_MICROSECONDS = 40000
+
 def clear_temp_dir():
   try:
     shutil.rmtree(temp_dir)
@@ -56,6 +74,51 @@ class TestStructureHelpers(unittest.TestCase):
         for (message, line_arrays, expected) in test_cases:
           self.assertEqualWithDiff(structure.joined_lines(*line_arrays), expected, message)
 
+    def test_lines_are_not_modified_by_indentation(self):
+        template = [Line("{"), Line("}")]
+        lines = structure.joined_lines([Line("", 0)], template)
+        options = structure.Options(beautifier.Options()).child(4)
+        options.indent_lines(lines)
+        self.assertEqualWithDiff(lines, [Line("{", 0), Line("}", 4)], "Indents the lines")
+        self.assertEqualWithDiff(template, [Line("{"), Line("}")], "Does not change the template")
+
+    def test_list_formatter(self):
+        specification = beautifier._parsed('bundle agent x { vars: "a" slist => { "b", "c" }; }',
+                                           None)[0]
+        constraint_list = specification.items[0]["block_child_list"].items[0]["class_promise_list"]
+        options = structure.Options(beautifier.Options())
+        def formatted(**list_args):
+            return structure.ListFormatter(**list_args).format(constraint_list, options)
+        self.assertEqualWithDiff(formatted(depth = 2, terminator = ",", end_terminator = ";"),
+                                 formatted(depth_fn = lambda list, node: 2,
+                                           terminator = ",", end_terminator = ";"),
+                                 "Constant depth is equal to depth function")
+        self.assertEqualWithDiff(formatted(start = [Line("(")], end = [Line(")")])[0].string,
+                                 "(\"a\"", "Uses start")
+
+    def test_layout_cache(self):
+        promise = 'files: "/a" perms => mog("644", "root", "root");'
+        original = "bundle agent a { %s } bundle agent b { %s }" % (promise, promise)
+        specification, options = beautifier._parsed(original, None)
+        layout_cache = options.layout_cache
+        beautified = specification.to_string(options)
+        self.assertTrue(0 < layout_cache.hits, "Reuses the layout of the repeated function call")
+        self.assertEqualWithDiff(beautified.count('perms => mog("644",'), 2,
+                                 "Reused layout is rendered in both bundles")
+
+    def test_appended_comment(self):
+        def comment(line_number, text):
+            return structure.Comment(structure.Position(line_number, line_number, 0, len(text)),
+                                     text, 0)
+        first = comment(1, "# first")
+        second = comment(2, "# second")
+        merged = first.appended(second)
+        self.assertEqualWithDiff(merged.text_lines, ["# first", "# second"], "Merges the lines")
+        self.assertEqualWithDiff((merged.position.start_line_number,
+                                  merged.position.end_line_number), (1, 2), "Merges the positions")
+        self.assertEqualWithDiff(first.text_lines, ["# first"], "Does not change the comment")
+        self.assertEqualWithDiff(first.position.end_line_number, 1, "Does not change the position")
+
     def test_find_index(self):
         self.assertEqualWithDiff(structure.find_index(lambda x: x == 3, [1, 2, 3, 4]),
                                  2, "Finds in middle of list")
@@ -116,6 +179,13 @@ def randomly_whitespaced(spec_string, line_endings):
                               spec_string.split(line_endings)))
               + random_chars(["\t", "", line_endings, ""], 3))
 
+def outcome(fn):
+    "Return the value returned by fn, or the name of the exception class if fn raises"
+    try:
+        return fn()
+    except Exception as error:
+        return error.__class__.__name__
+
 class TestEndToEnd(unittest.TestCase):
     def assertEqualLines(self, actual, expected, message):
         def numbered_lines(document):
@@ -169,6 +239,519 @@ class TestEndToEnd(unittest.TestCase):
 
         self._for_original_and_expected_in_each_cf_file(compare)
 
+    def test_write_beautified(self):
+        def compare(original_cf_string, expected, cf_file_name):
+            options = beautifier.Options()
+            def written():
+                stream = io.StringIO()
+                beautifier.write_beautified(original_cf_string, stream, options = options)
+                return stream.getvalue()
+            self.assertEqual(outcome(written),
+                             outcome(lambda: beautifier.beautified_string(original_cf_string,
+                                                                          options = options)),
+                             cf_file_name + " written differs from string")
+
+        self._for_original_and_expected_in_each_cf_file(compare)
+
+    def test_buffered_line_writer(self):
+        stream = io.StringIO()
+        writer = structure.BufferedLineWriter(stream, "\r\n", buffer_size = 10)
+        writer.write_lines([Line("a", 0)])
+        self.assertEqual("", stream.getvalue(), "Buffers until buffer is full")
+        writer.write_lines([Line("b", 4), Line("", 4, end_comments = [Line("# c")])])
+        self.assertEqual("a\r\n    b\r\n", stream.getvalue(), "Flushes when buffer is full")
+        writer.flush()
+        self.assertEqual("a\r\n    b\r\n    # c", stream.getvalue(), "Writes all lines after flush")
+
+    def test_beautified_range(self):
+        original = """# comment of a
+bundle agent a {
+vars:  "x" string => "y";
+}
+bundle agent b { vars: "z"   string => "w"; }
+"""
+        expected_b = """bundle agent b {
+    vars:
+            "z"
+                string => "w";
+}"""
+        beautified = beautifier.beautified_range(original, 5, 5)
+        self.assertEqualLines(beautified, "\n".join(original.split("\n")[0:4] + [expected_b, ""]),
+                              "Beautifies only the block on the range")
+        self.assertEqual(beautifier.beautified_range(original, 2, 3).split("\n")[-2],
+                         original.split("\n")[-2], "Does not touch blocks outside the range")
+        self.assertEqual(beautifier.beautified_range(original, 1, 1).split("\n")[1],
+                         "#", "Beautifies block with its preceding comment")
+        self.assertEqual(beautifier.beautified_range(original, 6, 6), original,
+                         "Returns string as is if no blocks in range")
+        try:
+            beautifier.beautified_range(original + 'body x y { a => => ; }', 6, 6)
+        except ParserError as error:
+            self.assertEqual(6, error.line_number, "Error has line number in the whole string")
+        else:
+            self.fail("Did not raise except")
+        broken = 'bundle agent a { vars: => }\nbody x y { a => => ; }\n'
+        try:
+            beautifier.beautified_range(broken, 2, 2)
+        except ParserError as error:
+            self.assertEqual((error.line_number, error.column, error.position),
+                             (2, 17, 44), "Reports error in range, not earlier error")
+        else:
+            self.fail("Did not raise except")
+
+    def test_beautified_edits(self):
+        original = """bundle agent a {
+vars:  "x" string => "y";  # end comment
+}
+body    x y { a => "b"; }
+"""
+        beautified = beautifier.beautified_string(original)
+        the_edits = beautifier.beautified_edits(original)
+        self.assertEqual(edits.applied_edits(original, the_edits), beautified, "Edits beautify")
+        self.assertTrue(all(map(lambda edit: original[edit[0]:edit[1]].strip() == ""
+                                             and edit[2].strip() == "", the_edits)),
+                        "Only white space is replaced when tokens are not changed")
+        self.assertEqual(beautifier.beautified_edits(beautified), [],
+                         "No edits for beautified string")
+        self.assertEqual(edits.text_edits("a b c d", "a x c  d"), [(2, 3, "x"), (6, 6, " ")],
+                         "Replaces changed tokens only")
+
+    def test_result_cache(self):
+        clear_temp_dir()
+        options = beautifier.Options()
+        result_cache = cache.ResultCache(temp_dir, options)
+        self.assertEqual(result_cache.beautified("x"), None, "Is empty initially")
+        result_cache.record("x", "x")
+        result_cache.record("y", "x\r\n")
+        self.assertEqual(result_cache.beautified("x"), "x", "Finds formatted input")
+        self.assertEqual(result_cache.beautified("y"), "x\r\n", "Finds beautified output")
+        self.assertEqual(result_cache.beautified("z"), None, "Does not find other input")
+        options.page_width = 10
+        self.assertEqual(cache.ResultCache(temp_dir, options).beautified("x"), None,
+                         "Does not find results recorded with other options")
+        stat_index = cache.StatIndex(temp_dir, options)
+        stat_index.record("a.cf", [1, 2, 3])
+        stat_index.save()
+        cache.evict(temp_dir, max_bytes = 1000)
+        self.assertEqual(result_cache.beautified("y"), "x\r\n", "Keeps entries under the limit")
+        cache.evict(temp_dir, max_bytes = 0)
+        self.assertEqual(result_cache.beautified("y"), None, "Evicts entries over the size limit")
+        self.assertEqual(os.listdir(os.path.join(temp_dir, "index")),
+                         [os.path.basename(stat_index.path)], "Does not evict index")
+        self.assertEqual(string_from_file(os.path.join(temp_dir, "size")), "0\n",
+                         "Sets size to the size of the entries left")
+
+    def test_atomically_written(self):
+        clear_temp_dir()
+        path = os.path.join(temp_dir, "a.cf")
+        with open(path, "w") as file:
+            file.write("original")
+        os.chmod(path, 0o640)
+        try:
+            with atomically_written(path) as file:
+                file.write("partial")
+                raise KeyboardInterrupt()
+        except KeyboardInterrupt:
+            pass
+        self.assertEqual(string_from_file(path), "original", "Interrupted write keeps original")
+        self.assertEqual(os.listdir(temp_dir), ["a.cf"], "Removes temporary file")
+        with atomically_written(path, fsyncs = True) as file:
+            file.write("new")
+        self.assertEqual(string_from_file(path), "new", "Replaces file")
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o640, "Keeps permissions")
+        os.makedirs(os.path.join(temp_dir, "tree"))
+        link_path = os.path.join(temp_dir, "tree", "a.cf")
+        os.symlink(os.path.join("..", "a.cf"), link_path)
+        with atomically_written(link_path) as file:
+            file.write("through link")
+        self.assertTrue(os.path.islink(link_path), "Keeps symbolic link")
+        self.assertEqual(string_from_file(path), "through link", "Replaces linked file")
+        clear_temp_dir()
+        os.makedirs(os.path.join(temp_dir, "real"))
+        os.makedirs(os.path.join(temp_dir, "tree"))
+        real_path = os.path.join(temp_dir, "real", "a.cf")
+        with open(real_path, "w") as file:
+            file.write("bundle agent a { vars: \"x\" string => \"y\"; }")
+        os.symlink(os.path.join("..", "real", "a.cf"), os.path.join(temp_dir, "tree", "a.cf"))
+        beautified_via_cli([os.path.join(temp_dir, "tree")], "")
+        self.assertTrue(os.path.islink(os.path.join(temp_dir, "tree", "a.cf")),
+                        "Beautifying symlinked input keeps link")
+        self.assertEqual(string_from_file(real_path),
+                         beautifier.beautified_string('bundle agent a { vars: "x" string => "y"; }'),
+                         "Beautifies file linked to")
+
+    def test_out_dir(self):
+        clear_temp_dir()
+        source_directory = os.path.join(temp_dir, "src")
+        os.makedirs(source_directory)
+        with open(os.path.join(source_directory, "a.cf"), "w") as file:
+            file.write("bundle agent a { vars: \"x\" string => \"y\"; }")
+        for output_directory, input_path in [(source_directory, source_directory),
+                                             (os.path.join(source_directory, "out"),
+                                              source_directory),
+                                             (temp_dir, source_directory)]:
+            out, err = beautified_via_cli(["--out-dir", output_directory, input_path], "")
+            self.assertTrue("--out-dir" in out, "Refuses nested output directory")
+        self.assertEqual(os.listdir(source_directory), ["a.cf"], "Writes nothing when refused")
+        output_directory = os.path.join(temp_dir, "out")
+        beautified_via_cli(["--out-dir", output_directory, source_directory], "")
+        self.assertEqual(string_from_file(os.path.join(output_directory, "a.cf")),
+                         beautifier.beautified_string('bundle agent a { vars: "x" string => "y"; }'),
+                         "Writes into separate output directory")
+        os.makedirs(os.path.join(temp_dir, "other"))
+        shutil.copy(os.path.join(source_directory, "a.cf"), os.path.join(temp_dir, "other"))
+        out, err = beautified_via_cli(["--out-dir", os.path.join(temp_dir, "out2"),
+                                       source_directory, os.path.join(temp_dir, "other")], "")
+        self.assertTrue("would write both" in out, "Refuses to write two files to one path")
+
+    def test_check_and_diff(self):
+        clear_temp_dir()
+        os.makedirs(os.path.join(temp_dir, "sub"))
+        ugly = 'bundle agent a { vars: "x" string => "y"; }'
+        paths = {}
+        for name, content in [("a.cf", ugly),
+                              ("b.cf", beautifier.beautified_string(ugly)),
+                              ("c.cf", "bundle agent c { vars: => }"),
+                              (os.path.join("sub", "d.cf"), ugly)]:
+            paths[os.path.basename(name)[0]] = os.path.join(temp_dir, name)
+            with open(os.path.join(temp_dir, name), "w") as file:
+                file.write(content)
+        status, out, err = run_cli(["--check", temp_dir])
+        self.assertEqual((status, out.splitlines()), (1, [paths["a"], paths["d"]]),
+                         "Lists files that are not beautiful, also after an error")
+        self.assertTrue(err.startswith(paths["c"] + ": Syntax error"), "Reports error")
+        status, out, err = run_cli(["--check", "--fail-fast", temp_dir])
+        self.assertEqual((status, out.splitlines(), err), (1, [paths["a"]], ""),
+                         "Stops at first file that is not beautiful")
+        status, out, err = run_cli(["--diff", temp_dir])
+        self.assertEqual(status, 1, "Fails with error")
+        self.assertEqual(re.findall(r"^--- (.*)\t", out, re.MULTILINE), [paths["a"], paths["d"]],
+                         "Diffs files that are not beautiful")
+        self.assertTrue(err.startswith(paths["c"] + ": Syntax error"), "Reports error in diff")
+        results_paths = [os.path.join(temp_dir, "%d.json" % index) for index in [1, 2]]
+        for index, results_path in enumerate(results_paths):
+            run_cli(["--check", "--shard", "%d/2" % (index + 1), "--results", results_path,
+                     temp_dir])
+        status, out, err = run_cli(["--merge-results"] + results_paths)
+        self.assertEqual((status, sorted(out.splitlines())), (1, [paths["a"], paths["d"]]),
+                         "Merges the results of shards")
+        self.assertTrue(err.startswith(paths["c"] + ": Syntax error"), "Merges errors")
+        self.assertEqual(run_cli(["--check", paths["b"]])[0], 0, "Passes beautiful file")
+
+    def test_stat_index(self):
+        clear_temp_dir()
+        path = os.path.join(temp_dir, "a.cf")
+        with open(path, "w") as file:
+            file.write("x")
+        options = beautifier.Options()
+        stat_index = cache.StatIndex(temp_dir, options)
+        self.assertFalse(stat_index.is_unchanged(path), "Is empty initially")
+        stat_index.record(path, cache.file_signature(path))
+        stat_index.save()
+        self.assertTrue(cache.StatIndex(temp_dir, options).is_unchanged(path),
+                        "Finds the saved signature")
+        with open(path, "w") as file:
+            file.write("xy")
+        self.assertFalse(cache.StatIndex(temp_dir, options).is_unchanged(path),
+                         "Does not find changed file")
+        other_stat_index = cache.StatIndex(temp_dir, options)
+        other_stat_index.record(path, cache.file_signature(path))
+        options.page_width = 10
+        self.assertFalse(cache.StatIndex(temp_dir, options).is_unchanged(path),
+                         "Is separate for other options")
+        other_stat_index.save()
+        self.assertEqual(len(cache.StatIndex(temp_dir, beautifier.Options()).signatures), 1,
+                         "Merges saved updates")
+
+    def test_is_beautiful(self):
+        original = 'bundle agent a { vars: "x" string => "y"; }'
+        beautified = beautifier.beautified_string(original)
+        self.assertFalse(beautifier.is_beautiful(original), "Original is not beautiful")
+        self.assertTrue(beautifier.is_beautiful(beautified), "Beautified is beautiful")
+        self.assertFalse(beautifier.is_beautiful(beautified + "\n"),
+                         "Text after beautiful output is not beautiful")
+
+    def test_unified_diff(self):
+        original = "a\nb\nc\nd\ne\nf\ng\nh\ni\nj"
+        beautified = "a\nB\nc\nd\ne\nf\ng\nh\ni\nj\n"
+        self.assertEqual(diff.unified_diff(original, beautified, "x.cf"),
+                         "--- x.cf\t(original)\n"
+                         "+++ x.cf\t(beautified)\n"
+                         "@@ -1,5 +1,5 @@\n"
+                         " a\n-b\n+B\n c\n d\n e\n"
+                         "@@ -7,4 +7,4 @@\n"
+                         " g\n h\n i\n-j\n\\ No newline at end of file\n+j\n",
+                         "Diffs changes in separate hunks")
+        self.assertEqual(diff.unified_diff(original, original, "x.cf"), "", "No diff if equal")
+        a, b = diff.line_ids(["a\n", "x\n", "b\n", "x\n"], ["x\n", "a\n", "x\n", "x\n", "b\n"])
+        self.assertEqual(diff.matching_line_pairs(a, b), [(0, 1), (1, 2), (2, 4)],
+                         "Aligns lines around unique lines")
+
+    def test_beautified_files(self):
+        clear_temp_dir()
+        paths = []
+        for index, string in enumerate(['bundle agent a { vars: "x" string => "y"; }',
+                                        "bundle agent a {\n}\n",
+                                        "bundle agent a { vars: => }"]):
+            paths.append(os.path.join(temp_dir, "%d.cf" % index))
+            with open(paths[-1], "w") as file:
+                file.write(string)
+        settings = batch.Settings(beautifier.Options(), os.path.join(temp_dir, "cache"), "stdout")
+        def results(jobs):
+            return list(map(lambda result: (result.path, result.status, result.output, result.error),
+                            batch.beautified_files(paths, settings, jobs)))
+        self.assertEqual(list(map(lambda result: result[1], results(1))),
+                         ["written", "written", "error"], "Reports status of each file")
+        self.assertEqual(results(2), results(1), "Results of worker pool are in order")
+        original_worker_pool = batch.worker_pool
+        batch.worker_pool = None # Fails if called
+        try:
+            self.assertEqual(list(batch.beautified_files(iter([]), settings, 2)), [],
+                             "Does not start pool for no files")
+        finally:
+            batch.worker_pool = original_worker_pool
+        timings = cache.Timings(os.path.join(temp_dir, "cache"))
+        timings.record(paths[1], 2.0)
+        costs = batch.expected_costs(paths, settings, timings)
+        self.assertEqual(costs[paths[1]], 2.0, "Uses timing of timed file")
+        self.assertAlmostEqual(costs[paths[0]],
+                               2.0 * os.path.getsize(paths[0]) / os.path.getsize(paths[1]),
+                               msg = "Scales size of untimed file by time per byte")
+        self.assertEqual(list(map(lambda result: (result.path, result.status, result.output,
+                                                  result.error),
+                                  batch.beautified_files(paths, settings, 2, costs = costs))),
+                         results(1), "Results of files scheduled by costs are in order")
+        cost_window = batch.COST_WINDOW
+        batch.COST_WINDOW = 2
+        pool = batch.worker_pool(2)
+        try:
+            self.assertEqual(list(map(lambda result: result.path,
+                                      batch.beautified_files(iter(paths), settings, pool = pool,
+                                                             costs = lambda window_paths:
+                                                                 dict.fromkeys(window_paths, 1)))),
+                             paths, "Results of files scheduled by windows of costs are in order")
+            ints = []
+            try:
+                for result in batch._results_in_order_of_costs(pool, int,
+                                                               iter(["3", "1", "x", "2"]),
+                                                               lambda window: [1, 2]):
+                    ints.append(result)
+            except ValueError:
+                pass
+            self.assertEqual(ints, [3, 1], "Yields results preceding exception")
+        finally:
+            batch.COST_WINDOW = cost_window
+            pool.terminate()
+            pool.join()
+        settings.mode = "check"
+        self.assertEqual(list(map(lambda result: result[1], results(1))),
+                         ["unformatted", "unchanged", "error"], "Checks files")
+        self.assertEqual(string_from_file(paths[0]), 'bundle agent a { vars: "x" string => "y"; }',
+                         "Check does not write files")
+        for jobs in [1, 2]:
+            paths_and_inputs = map(lambda path: (path, string_from_file(path)), paths)
+            strings_results = batch.beautified_strings(paths_and_inputs, settings, jobs)
+            self.assertEqual(list(map(lambda result: result.status, strings_results)),
+                             ["unformatted", "unchanged", "error"], "Checks strings")
+        settings = batch.Settings(beautifier.Options(), None, "write", links_unchanged = True)
+        output_paths = dict(map(lambda path: (path, os.path.join(temp_dir, "out", "sub",
+                                                                 os.path.basename(path))),
+                                paths[:2]))
+        for jobs in [1, 2]:
+            self.assertEqual(list(map(lambda result: result.status,
+                                      batch.beautified_files(iter(paths[:2]), settings, jobs,
+                                                             output_paths = output_paths))),
+                             ["beautified", "unchanged"], "Writes to output paths")
+        self.assertEqual(string_from_file(paths[0]), 'bundle agent a { vars: "x" string => "y"; }',
+                         "Does not write input files")
+        self.assertEqual(string_from_file(output_paths[paths[0]]),
+                         beautifier.beautified_string(string_from_file(paths[0])),
+                         "Writes beautified file to output path")
+        self.assertEqual(os.stat(output_paths[paths[1]]).st_ino, os.stat(paths[1]).st_ino,
+                         "Links unchanged file")
+
+    def test_walk(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        for relative_path in ["b.cf", "a.txt", "z/c.cf", "y/d.cf", "y/e.cf", "build/f.cf",
+                              ".git/g.cf"]:
+            path = os.path.join(directory, relative_path)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, "w") as file:
+                file.write("")
+        with open(os.path.join(directory, "y", ".gitignore"), "w") as file:
+            file.write("# Comment\n*.cf\n!e.cf\n")
+        os.symlink(os.path.join(directory, "y"), os.path.join(directory, "x"))
+        def relative_paths(**arguments):
+            return [relative_path.replace(os.sep, "/")
+                    for path, relative_path in walk.files(directory, **arguments)]
+        self.assertEqual(relative_paths(),
+                         ["b.cf", "build/f.cf", "y/d.cf", "y/e.cf", "z/c.cf"],
+                         "Files before directories in name order, skipping .git and linked dir")
+        self.assertEqual(relative_paths(excludes = ["build", "z/*.cf"]),
+                         ["b.cf", "y/d.cf", "y/e.cf"])
+        self.assertEqual(relative_paths(includes = ["*.txt", "y/d.cf"]), ["a.txt", "y/d.cf"])
+        self.assertEqual(relative_paths(uses_gitignore = True),
+                         ["b.cf", "build/f.cf", "y/e.cf", "z/c.cf"],
+                         "Applies .gitignore in its directory, with negation")
+        self.assertEqual(relative_paths(symlinks = walk.FOLLOW_SYMLINKS),
+                         ["b.cf", "build/f.cf", "x/d.cf", "x/e.cf", "z/c.cf"],
+                         "Walks each directory once")
+        os.symlink(os.path.join(directory, "b.cf"), os.path.join(directory, "a.cf"))
+        self.assertEqual(relative_paths(excludes = ["build", "y", "z"]), ["a.cf", "b.cf"])
+        self.assertEqual(relative_paths(excludes = ["build", "y", "z"],
+                                        symlinks = walk.SKIP_SYMLINKS),
+                         ["b.cf"])
+        path = os.path.join(directory, "b.cf")
+        self.assertEqual(list(walk.files(path)), [(path, "b.cf")], "Yields input file as is")
+
+    def test_limits(self):
+        def busy():
+            with limits.limited(seconds = 0.05):
+                while True:
+                    pass
+        self.assertRaises(limits.LimitExceeded, busy)
+        if sys.platform.startswith("linux"):
+            def allocating():
+                with limits.limited(megabytes = 10):
+                    strings = []
+                    while True:
+                        strings.append("x" * 1024 * 1024)
+                        time.sleep(0.001)
+            self.assertRaises(limits.LimitExceeded, allocating)
+        with limits.limited(seconds = 10, megabytes = 100):
+            pass
+        time.sleep(0.06) # Does not interrupt after the block
+        input = "".join('bundle agent a%d { vars: "x" string => "y"; }\n' % index
+                        for index in range(200))
+        settings = batch.Settings(beautifier.Options(), None, "check", time_limit = 0.001)
+        result = batch.beautify_string("slow.cf", input, settings)
+        self.assertEqual(result.status, "exceeded")
+        self.assertTrue(re.match(r"Too slow: over 0.001 s while \w+ \(in [\w.]+\)", result.error),
+                        result.error)
+        settings = batch.Settings(beautifier.Options(), None, time_limit = 0.2)
+        original_write_file = batch._write_file
+        def slow_write_file(*arguments):
+            time.sleep(0.3)
+            original_write_file(*arguments)
+        batch._write_file = slow_write_file
+        try:
+            clear_temp_dir()
+            path = os.path.join(temp_dir, "a.cf")
+            with open(path, "w") as file:
+                file.write('bundle agent a { vars: "x" string => "y"; }')
+            self.assertEqual(batch.beautify_file(path, settings).status, "beautified",
+                             "Does not limit writing")
+        finally:
+            batch._write_file = original_write_file
+        clear_temp_dir()
+        paths = []
+        for index in range(4):
+            paths.append(os.path.join(temp_dir, "%d.cf" % index))
+            with open(paths[-1], "w") as file:
+                file.write("bundle agent a\n{\n}\n")
+        settings = batch.Settings(beautifier.Options(), None, "check")
+        workers = set(result.worker for result in batch.beautified_files(paths, settings, 2,
+                                                                        files_per_worker = 1))
+        self.assertEqual(len(workers), 4, "Replaces workers after files_per_worker files")
+
+    def test_shard(self):
+        clear_temp_dir()
+        paths = []
+        for index in range(20):
+            paths.append(os.path.join(temp_dir, "%02d.cf" % index))
+            with open(paths[-1], "w") as file:
+                file.write("x" * (index * 10))
+        self.assertEqual(shard.parsed("2/3"), (2, 3))
+        for invalid in ["3", "0/3", "4/3", "a/b"]:
+            self.assertRaises(ValueError, shard.parsed, invalid)
+        items = [(path, path) for path in paths]
+        for shard_items in [lambda index: list(shard.hashed(iter(items), index, 3)),
+                            lambda index: shard.size_balanced(items, index, 3)]:
+            shards = list(map(shard_items, [1, 2, 3]))
+            self.assertEqual(sorted(sum(shards, [])), items, "Each file is in one shard")
+            self.assertEqual(list(map(shard_items, [1, 2, 3])), shards, "Assignment is stable")
+        walked_shards = [[relative_path
+                          for path, relative_path in shard.hashed(walk.files(input_path), 1, 3)]
+                         for input_path in [os.path.relpath(temp_dir), os.path.abspath(temp_dir)]]
+        self.assertEqual(walked_shards[0], walked_shards[1],
+                         "Assignment does not depend on how the input directory is given")
+        sizes = [sum(os.path.getsize(path) for path, relative_path in shard.size_balanced(items,
+                                                                                      index, 3))
+                 for index in [1, 2, 3]]
+        self.assertTrue(max(sizes) - min(sizes) <= 190, "Balances sizes")
+        result_paths = []
+        for index, statuses in [(1, ["unchanged"]), (2, ["unformatted", "error"])]:
+            result_paths.append(os.path.join(temp_dir, "%d.json" % index))
+            records = [{ "path": "%d-%d.cf" % (index, position), "status": status,
+                         "error": None, "output": None }
+                       for position, status in enumerate(statuses)]
+            shard.write_results(result_paths[-1], (index, 2), "check", records,
+                                "error" in statuses)
+        merged = shard.merged_results(list(reversed(result_paths)))
+        self.assertEqual(list(map(lambda entry: entry["path"], merged["files"])),
+                         ["1-0.cf", "2-0.cf", "2-1.cf"], "Merges in order of shards")
+        self.assertTrue(merged["failed"])
+        self.assertRaises(shard.ShardError, shard.merged_results, result_paths[:1])
+        self.assertRaises(shard.ShardError, shard.merged_results, result_paths[:1] * 2)
+
+    def test_archive(self):
+        import tarfile
+        import zipfile
+        clear_temp_dir()
+        original = 'bundle agent a { vars: "x" string => "y"; }'
+        beautiful = beautifier.beautified_string(original)
+        members = [("a.cf", original.encode("utf-8")),
+                   ("b.cf", beautiful.encode("utf-8")),
+                   ("data.bin", b"\xff\x00")]
+        tar_path = os.path.join(temp_dir, "policy.tar.gz")
+        with tarfile.open(tar_path, "w:gz") as tar:
+            for name, data in members:
+                info = tarfile.TarInfo(name)
+                info.size, info.mtime, info.mode = len(data), 1000000000, 0o600
+                tar.addfile(info, io.BytesIO(data))
+        zip_path = os.path.join(temp_dir, "policy.zip")
+        with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as zip_file:
+            for name, data in members:
+                zip_file.writestr(zipfile.ZipInfo(name, (2001, 9, 9, 1, 46, 40)), data)
+        def statuses(path, mode, output_path = None):
+            settings = batch.Settings(beautifier.Options(), None, mode)
+            return [(result.path, result.status)
+                    for result in archive.beautified_members(path, settings, output_path)]
+        for path in [tar_path, zip_path]:
+            self.assertEqual(statuses(path, "check"),
+                             [("a.cf", "unformatted"), ("b.cf", "unchanged")],
+                             "Checks .cf members")
+            output_path = path.replace("policy", "beautified")
+            self.assertEqual(statuses(path, "write", output_path),
+                             [("a.cf", "beautified"), ("b.cf", "unchanged")],
+                             "Beautifies .cf members")
+            self.assertEqual(statuses(output_path, "check"),
+                             [("a.cf", "unchanged"), ("b.cf", "unchanged")],
+                             "Writes beautified archive")
+        with tarfile.open(tar_path.replace("policy", "beautified")) as tar:
+            self.assertEqual([(info.name, info.mtime, info.mode) for info in tar.getmembers()],
+                             [(name, 1000000000, 0o600) for name, data in members],
+                             "Keeps tar member metadata")
+            self.assertEqual(tar.extractfile("data.bin").read(), b"\xff\x00",
+                             "Copies other tar members")
+        with zipfile.ZipFile(zip_path.replace("policy", "beautified")) as zip_file:
+            self.assertEqual([(info.filename, info.date_time) for info in zip_file.infolist()],
+                             [(name, (2001, 9, 9, 1, 46, 40)) for name, data in members],
+                             "Keeps zip member metadata")
+            self.assertEqual(zip_file.read("data.bin"), b"\xff\x00", "Copies other zip members")
+        output_path = os.path.join(temp_dir, "beautified.tar")
+        statuses(tar_path, "write", output_path)
+        with tarfile.open(output_path, "r:") as tar:
+            self.assertEqual(len(tar.getmembers()), 3,
+                             "Compresses by the extension of the output path")
+        with zipfile.ZipFile(zip_path, "a") as zip_file:
+            zip_file.writestr("latin1.cf", b"\xe4")
+        self.assertEqual(statuses(zip_path, "check"),
+                         [("a.cf", "unformatted"), ("b.cf", "unchanged"), ("latin1.cf", "error")],
+                         "Reports member that is not UTF-8 as error")
+
     def assertBeautifies(self, original, expected, options, message):
         beautified = beautifier.beautified_string(original,
                                                   options = options)
@@ -250,15 +833,157 @@ class TestEndToEnd(unittest.TestCase):
 
         self._for_original_and_expected_in_each_cf_file(compare)
 
+    @unittest.skipIf(sys.version_info < (3, 7), "python -X importtime needs Python 3.7")
+    def test_startup_import_time(self):
+        # Best of a few, as a single run may be slowed down by whatever else the machine is doing
+        total, times = min(benchmark.import_times(benchmark.STARTUP_IMPORTS) for run in range(3))
+        self.assertEqual(set(),
+                         set(times.keys()) & set(["cfbeautifier.parser", "cfbeautifier.structure",
+                                                  "cfbeautifier.ply.yacc", "multiprocessing"]),
+                         "Parser and worker pool are not imported on start up")
+        self.assertLess(total, STARTUP_IMPORT_TIME_BUDGET_MICROSECONDS)
+
+    def test_git_changed_paths(self):
+        clear_temp_dir()
+        def run_git(*args):
+            subprocess.check_call(["git", "-c", "user.name=test", "-c", "user.email=test@test"]
+                                      + list(args),
+                                  cwd = temp_dir, stdout = subprocess.PIPE)
+        def write(path, content):
+            with open(os.path.join(temp_dir, path), "w") as file:
+                file.write(content)
+        run_git("init", "-q")
+        for path in ["a.cf", "b.cf", "c.cf", "d.cf", "x.txt"]:
+            write(path, path)
+        run_git("add", ".")
+        run_git("commit", "-q", "-m", "First")
+        write("a.cf", "changed")
+        write("x.txt", "changed")
+        os.makedirs(os.path.join(temp_dir, "sub"))
+        run_git("mv", "b.cf", "sub/b.cf")
+        run_git("rm", "-q", "c.cf")
+        write("e.cf", "added")
+        run_git("add", "e.cf")
+        write("d.cf", "staged")
+        run_git("add", "d.cf")
+        self.assertEqual(sorted(git.changed_paths(directory = temp_dir)), ["a.cf"],
+                         "Finds .cf files changed in the working tree")
+        self.assertEqual(sorted(git.changed_paths(staged = True, directory = temp_dir)),
+                         ["d.cf", "e.cf", "sub/b.cf"],
+                         "Finds staged .cf files, renamed by their new name, but not deleted")
+        self.assertEqual(sorted(git.changed_paths("HEAD", directory = temp_dir)),
+                         ["a.cf", "d.cf", "e.cf", "sub/b.cf"],
+                         "Finds .cf files changed since revision")
+        self.assertEqual(git.changed_paths("HEAD", pathspecs = ["sub"], directory = temp_dir),
+                         ["sub/b.cf"], "Finds changed files in pathspecs only")
+        self.assertRaises(git.GitError, git.changed_paths, "unknown", directory = temp_dir)
+        files = git.tree_files("HEAD", directory = temp_dir)
+        self.assertEqual([path for path, blob_id in files], ["a.cf", "b.cf", "c.cf", "d.cf"],
+                         "Lists .cf files in revision")
+        self.assertEqual(list(git.blob_contents(files, directory = temp_dir)),
+                         [("a.cf", "a.cf"), ("b.cf", "b.cf"), ("c.cf", "c.cf"), ("d.cf", "d.cf")],
+                         "Reads files in revision")
+        with open(os.path.join(temp_dir, "a.cf"), "wb") as file:
+            file.write(b"\xff")
+        run_git("commit", "-q", "-a", "-m", "Second")
+        files = git.tree_files("HEAD", ["a.cf"], directory = temp_dir)
+        self.assertEqual(list(git.blob_contents(files, temp_dir, decodes = False)),
+                         [("a.cf", b"\xff")], "Reads files as bytes")
+        settings = batch.Settings(beautifier.Options(), None, "check")
+        self.assertEqual([result.status for result in
+                          batch.beautified_strings(git.blob_contents(files, temp_dir,
+                                                                     decodes = False),
+                                                   settings)],
+                         ["error"], "Reports file that is not UTF-8 as error")
+
+    def test_jsonl(self):
+        import json
+        source = "bundle agent x{vars: 'a' string => 'b';}"
+        windows_options = beautifier.Options()
+        windows_options.line_endings = "\r\n"
+        lines = [json.dumps({ "id": 1, "source": source }),
+                 "",
+                 json.dumps({ "id": "two", "source": source,
+                              "options": { "line_endings": "windows" } }),
+                 json.dumps({ "id": 3, "source": "bundle agent x{\nvars: 'a' string => ;}" }),
+                 json.dumps({ "id": 4, "source": "", "options": { "unknown": 1 } }),
+                 json.dumps({ "id": 5, "source": source, "options": { "page_width": "abc" } }),
+                 json.dumps({ "id": 6, "source": 5 }),
+                 json.dumps({ "id": 7, "source": source, "options": { "line_endings": "mac" } }),
+                 json.dumps({ "id": 8, "source": source, "options": { "__class__": 1 } }),
+                 "{"]
+        expected = [{ "id": 1, "output": beautifier.beautified_string(source) },
+                    { "id": "two",
+                      "output": beautifier.beautified_string(source, windows_options) },
+                    { "id": 3,
+                      "error": { "message": "Syntax error, line 2, column 21: ';'",
+                                 "line_number": 2,
+                                 "column": 21,
+                                 "position": 36,
+                                 "fragment": ";" } },
+                    { "id": 4, "error": { "message": "Unknown option 'unknown'" } },
+                    { "id": 5, "error": { "message": "Invalid page_width \"abc\", expected a "
+                                                     "positive integer" } },
+                    { "id": 6, "error": { "message": "source is not a string" } },
+                    { "id": 7, "error": { "message": "Invalid line_endings \"mac\", expected "
+                                                     "\"windows\", \"unix\" or \"detect\"" } },
+                    { "id": 8, "error": { "message": "Unknown option '__class__'" } }]
+        for jobs, in_order in [(1, True), (2, True), (2, False)]:
+            results = list(jsonl.responses(lines, beautifier.Options(), jobs, in_order))
+            invalid_results = [result for result in results if result["id"] == None]
+            self.assertEqual(1, len(invalid_results))
+            self.assertTrue(invalid_results[0]["error"]["message"].startswith("Invalid JSON"))
+            if not in_order:
+                results.sort(key = lambda result: str(result["id"]))
+                expected = sorted(expected, key = lambda result: str(result["id"]))
+            self.assertEqual(expected, [result for result in results if result["id"] != None])
+        broken_options = beautifier.Options()
+        broken_options.page_width = None
+        self.assertTrue(jsonl.response(lines[0], broken_options)["error"]["message"]
+                            .startswith("Unexpected error: "),
+                        "Answers request that fails unexpectedly with error")
+
+    def test_daemon(self):
+        clear_temp_dir()
+        process = subprocess.Popen(["./cf-beautify", "--daemon", "--cache-dir", temp_dir,
+                                    "--idle-timeout", "10"])
+        try:
+            socket_path = daemon.default_socket_path(temp_dir)
+            for i in range(100):
+                connection = daemon.connected(socket_path)
+                if connection:
+                    break
+                time.sleep(0.1)
+            original = 'bundle agent a { vars: "x" string => "y"; }'
+            self.assertEqual(daemon.beautified_string(connection, original, beautifier.Options()),
+                             beautifier.beautified_string(original), "Beautifies in daemon")
+            path = os.path.join(temp_dir, "a.cf")
+            with open(path, "w") as file:
+                file.write(original)
+            settings = batch.Settings(beautifier.Options(), None, "check")
+            results = daemon.beautified_files(daemon.connected(socket_path), [path], settings)
+            self.assertEqual(list(map(lambda result: result.status, results)), ["unformatted"],
+                             "Beautifies files in daemon")
+        finally:
+            process.terminate()
+            process.wait()
+        self.assertEqual(daemon.connected(socket_path), None, "Daemon is not running")
+
 def beautified_via_cli(args, input):
-    process = subprocess.Popen(["./cf-beautify"] + args,
+    status, out, err = run_cli(args, input)
+    return (out, err)
+
+def run_cli(args, input = ""):
+    "Return (exit status, stdout, stderr) of cf-beautify with args"
+    # Not affected by the results cached by other runs, or by a daemon that is running
+    process = subprocess.Popen(["./cf-beautify", "--no-cache", "--no-daemon"] + args,
                                stdin = subprocess.PIPE,
                                stdout = subprocess.PIPE,
                                stderr = subprocess.PIPE)
     out, err = process.communicate(input.encode("utf-8"))
     out = out.decode('utf-8-sig')
     err = err.decode('utf-8-sig')
-    return (out, err)
+    return (process.returncode, out, err)
 
 def main():
     unittest.main()
@@ -0,0 +1,140 @@
+"""
+Rendering and startup benchmark. Run with: python -m cfbeautifier.test.benchmark [repeat_count]
+
+The corpus is built by concatenating the test cf files (that beautify without errors) repeat_count
+times, which gives a large policy with the kind of repetition real policies have.
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from .. import beautifier
+from .. import structure
+from ..version_abstraction import string_from_file
+import os
+import subprocess
+import sys
+import time
+
+try:
+    import tracemalloc
+except ImportError: # Python 2
+    tracemalloc = None
+
+test_cf_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "test_cfs")
+
+def corpus_files():
+    "Return (name, string) pairs of the test cf files that can be beautified"
+    def can_be_beautified(string):
+        try:
+            beautifier.beautified_string(string)
+            return True
+        except Exception:
+            return False
+    files = []
+    for name in sorted(os.listdir(test_cf_dir)):
+        if name.endswith(".cf") and not "expected" in name:
+            string = string_from_file(os.path.join(test_cf_dir, name))
+            # Mixed line endings would make the concatenated policy differ from the files
+            if string.strip() and not "\r\n" in string and can_be_beautified(string):
+                files.append((name, string))
+    return files
+
+def corpus(repeat_count):
+    return "\n".join([string for name, string in corpus_files()] * repeat_count)
+
+class Measurement(object):
+    def __init__(self, seconds, peak_bytes, result):
+        self.seconds = seconds
+        self.peak_bytes = peak_bytes
+        self.result = result
+
+def measure(fn, traces_memory = False):
+    """
+    Calls fn, and returns Measurement of the wall time and, if traces_memory, peak traced memory.
+    Tracing memory slows down fn considerably.
+    """
+    traces_memory = traces_memory and tracemalloc
+    if traces_memory:
+        tracemalloc.start()
+    start = time.time()
+    result = fn()
+    seconds = time.time() - start
+    if traces_memory:
+        peak_bytes = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    else:
+        peak_bytes = None
+    return Measurement(seconds, peak_bytes, result)
+
+# Modules that cf-beautify imports on start up, before knowing what it needs to do
+STARTUP_IMPORTS = ("import cfbeautifier.beautifier, cfbeautifier.batch, cfbeautifier.cache,"
+                   " cfbeautifier.daemon")
+
+def import_times(code):
+    """
+    Return (total import time, {module name: cumulative import time}) pair, in microseconds, of
+    running code in a new Python (3.7+) process, as reported by python -X importtime. The modules
+    imported by Python itself on start up are not included.
+    """
+    def times(code):
+        process = subprocess.Popen([sys.executable, "-X", "importtime", "-c", code],
+                                   cwd = os.path.join(test_cf_dir, "..", "..", ".."),
+                                   stdout = subprocess.PIPE,
+                                   stderr = subprocess.PIPE)
+        out, err = process.communicate()
+        all_times = {}
+        top_level_times = {}
+        for line in err.decode("utf-8").splitlines():
+            fields = line.split("|")
+            if len(fields) == 3 and fields[1].strip().isdigit():
+                name = fields[2].strip()
+                all_times[name] = int(fields[1])
+                # Nested imports are indented
+                if not fields[2].startswith("  "):
+                    top_level_times[name] = int(fields[1])
+        return (top_level_times, all_times)
+    python_names = set(times("pass")[1].keys())
+    top_level_times, all_times = times(code)
+    return (sum([time for name, time in top_level_times.items() if not name in python_names]),
+            dict([(name, time) for name, time in all_times.items() if not name in python_names]))
+
+def main(repeat_count):
+    if (3, 7) <= sys.version_info:
+        total, times = import_times(STARTUP_IMPORTS)
+        print("Startup imports: %.1f ms, %d modules" % (total / 1000.0, len(times)))
+
+    string = corpus(repeat_count)
+    print("Corpus: %d lines, %d characters" % (string.count("\n") + 1, len(string)))
+    # Warm up (parser tables etc)
+    beautifier.beautified_string(string)
+
+    print("Beautify time: %.3f s" % measure(lambda: beautifier.beautified_string(string)).seconds)
+    if tracemalloc:
+        traced = measure(lambda: beautifier.beautified_string(string), traces_memory = True)
+        print("Peak memory: %.1f KiB (traced run took %.3f s)"
+                  % (traced.peak_bytes / 1024.0, traced.seconds))
+
+    # Rendering only, on an already parsed specification
+    specification, options = beautifier._parsed(string, None)
+    promise_count = len(list(filter(lambda node: isinstance(node, structure.Promise),
+                                    specification.descendants())))
+    def render_fn():
+        # A fresh layout cache, so that each render lays out everything again
+        render_options = options.modified(layout_cache = structure.LayoutCache())
+        return lambda: specification.to_string(render_options)
+    # Best of several runs, as a single render is short enough to be noisy
+    render_seconds = min([measure(render_fn()).seconds for i in range(5)])
+    print("Render time (best of 5): %.3f s, %.1f us per promise (%d promises)"
+              % (render_seconds, render_seconds * 1000000 / max(promise_count, 1), promise_count))
+    layout_cache = structure.LayoutCache()
+    specification.to_string(options.modified(layout_cache = layout_cache))
+    print("Layout cache: %d hits, %d misses, hit rate %.1f%%"
+              % (layout_cache.hits, layout_cache.misses, 100 * layout_cache.hit_rate()))
+    if tracemalloc:
+        traced = measure(render_fn(), traces_memory = True)
+        print("Render peak memory: %.1f KiB, %.0f bytes per promise"
+                  % (traced.peak_bytes / 1024.0, traced.peak_bytes / max(promise_count, 1)))
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if 1 < len(sys.argv) else 20)
@@ -1,6 +1,8 @@
 from __future__ import absolute_import
 from __future__ import print_function
 from __future__ import unicode_literals
+import contextlib
+import os
 
 def previous_end_of_line_pos(string, lexpos):
     "Return -1 if at the beginning of string"
@@ -16,3 +18,60 @@ class ParserError(Exception):
         self.fragment = fragment
         Exception.__init__(self,
                            "Syntax error, line %d, column %d: '%s'" % (line_number, self.column, fragment))
+
+def _umask():
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+@contextlib.contextmanager
+def atomically_written(path, fsyncs = False, mode = "w"):
+    """
+    Context manager that opens a temporary file (with mode) in the directory of path, and when
+    the block completes, renames it over the file at path. The file at path is therefore never
+    left partially written, even if interrupted or out of disk space. Keeps the permissions and
+    (if allowed) the owner of the file. If path is a symbolic link, the file it links to is
+    replaced, and the link kept. If fsyncs, the file and the rename are flushed to disk before
+    returning.
+    """
+    import tempfile # On first use, to keep the startup of cf-beautify fast
+    path = os.path.realpath(path)
+    directory = os.path.dirname(path)
+    descriptor, temp_path = tempfile.mkstemp(dir = directory, prefix = ".tmp")
+    try:
+        with os.fdopen(descriptor, mode) as file:
+            yield file
+            if fsyncs:
+                file.flush()
+                os.fsync(file.fileno())
+        try:
+            stat = os.stat(path)
+            os.chmod(temp_path, stat.st_mode & 0o7777)
+            if hasattr(os, "chown"):
+                try:
+                    os.chown(temp_path, stat.st_uid, stat.st_gid)
+                except OSError: # Only the superuser may give files away
+                    pass
+        except OSError: # A new file
+            os.chmod(temp_path, 0o666 & ~_umask())
+        os.rename(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+    if fsyncs and hasattr(os, "O_DIRECTORY"):
+        directory_descriptor = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(directory_descriptor)
+        finally:
+            os.close(directory_descriptor)
+
+def sync():
+    "Flush all the written files to disk"
+    if hasattr(os, "sync"):
+        os.sync()
+    else:
+        import subprocess
+        subprocess.call(["sync"])
@@ -13,6 +13,13 @@ if sys.version_info[0] < 3:
     def write_stream(stream, output):
         stream.write(output.encode("utf-8"))
 
+    class text_writer(object):
+        "Wraps a byte stream so that text may be written into it"
+        def __init__(self, stream):
+            self.stream = stream
+        def write(self, output):
+            write_stream(self.stream, output)
+
 else:
     text_class = str
 
@@ -25,3 +32,6 @@ else:
 
     def write_stream(stream, output):
         stream.write(output)
+
+    def text_writer(stream):
+        return stream
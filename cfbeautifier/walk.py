@@ -0,0 +1,146 @@
+"""
+Finding the files to beautify under the input directories.
+
+Include and exclude patterns are shell style globs. A pattern with a slash is matched against the
+path relative to the input directory, and a pattern without one against the name of the file or
+directory, as in .gitignore. The .gitignore files found in the walked directories are supported
+for the common patterns: negation with !, directory only patterns ending with /, and patterns
+anchored with a leading or middle /. The directories and files are walked in the order of their
+names, and the files of a directory before its sub directories.
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+import fnmatch
+import io
+import os
+
+try:
+    from os import scandir
+except ImportError: # Python 2
+    scandir = None
+
+DEFAULT_INCLUDES = ["*.cf"]
+# Version control directories never contain policy to beautify
+DEFAULT_EXCLUDES = [".git", ".hg", ".svn"]
+
+# Symbolic link policies
+SKIP_SYMLINKS = "skip" # Neither files nor directories
+FILE_SYMLINKS = "files" # Files, but do not walk into linked directories
+FOLLOW_SYMLINKS = "follow" # Files and directories, walking each directory once
+
+class _Entry(object):
+    "As os.DirEntry, for Python 2"
+    def __init__(self, directory, name):
+        self.name = name
+        self.path = os.path.join(directory, name)
+    def is_symlink(self):
+        return os.path.islink(self.path)
+    def is_dir(self, follow_symlinks = True):
+        return os.path.isdir(self.path) and (follow_symlinks or not self.is_symlink())
+    def is_file(self):
+        return os.path.isfile(self.path)
+
+def _entries(directory):
+    "Return the entries of the directory in the order of their names, or [] if cannot read it"
+    try:
+        if scandir:
+            entries = list(scandir(directory))
+        else:
+            entries = [_Entry(directory, name) for name in os.listdir(directory)]
+    except OSError:
+        return []
+    return sorted(entries, key = lambda entry: entry.name)
+
+def _matches(pattern, relative_path):
+    "relative_path is relative to the directory that the pattern applies in, separated by /"
+    if "/" in pattern:
+        return fnmatch.fnmatchcase(relative_path, pattern)
+    return fnmatch.fnmatchcase(relative_path.rsplit("/", 1)[-1], pattern)
+
+class _IgnoreRule(object):
+    "A pattern of a .gitignore file"
+    def __init__(self, base, line):
+        self.base = base # relative path of the directory of the .gitignore, "" for the root
+        self.is_negated = line.startswith("!")
+        line = line.lstrip("!")
+        self.is_directory_only = line.endswith("/")
+        line = line.rstrip("/")
+        if line.startswith("**/"): # In any directory, as without a slash
+            line = line[3:]
+        self.is_anchored = "/" in line
+        self.pattern = line.lstrip("/")
+
+    def matches(self, relative_path, is_directory):
+        if self.is_directory_only and not is_directory:
+            return False
+        if self.base:
+            if not relative_path.startswith(self.base + "/"):
+                return False
+            relative_path = relative_path[len(self.base) + 1:]
+        if self.is_anchored:
+            return fnmatch.fnmatchcase(relative_path, self.pattern)
+        return _matches(self.pattern, relative_path)
+
+def _ignore_rules(path, base):
+    "Return the rules of the .gitignore file at path"
+    try:
+        with io.open(path, encoding = "utf-8", errors = "replace") as file:
+            lines = [line.rstrip("\r\n").rstrip(" ") for line in file]
+    except (IOError, OSError):
+        return []
+    return [_IgnoreRule(base, line) for line in lines if line and not line.startswith("#")]
+
+def _is_ignored(rules, relative_path, is_directory):
+    ignored = False
+    for rule in rules: # The last matching rule decides
+        if rule.matches(relative_path, is_directory):
+            ignored = not rule.is_negated
+    return ignored
+
+def files(input_path,
+          includes = DEFAULT_INCLUDES,
+          excludes = [],
+          uses_gitignore = False,
+          symlinks = FILE_SYMLINKS):
+    """
+    Yield (path, path relative to input_path) of each file under the directory at input_path that
+    matches includes and does not match excludes (or DEFAULT_EXCLUDES) or the .gitignore files
+    if uses_gitignore, as they are found. If input_path is a file, yields it as is.
+    """
+    if not os.path.isdir(input_path):
+        yield (input_path, os.path.basename(input_path))
+        return
+    excludes = DEFAULT_EXCLUDES + list(excludes)
+    visited_directories = set()
+    def walk(directory, relative_directory, rules):
+        if symlinks == FOLLOW_SYMLINKS:
+            # Linked directories may form a loop
+            stat = os.stat(directory)
+            if (stat.st_dev, stat.st_ino) in visited_directories:
+                return
+            visited_directories.add((stat.st_dev, stat.st_ino))
+        entries = _entries(directory)
+        if uses_gitignore and any(entry.name == ".gitignore" for entry in entries):
+            rules = rules + _ignore_rules(os.path.join(directory, ".gitignore"),
+                                          relative_directory)
+        sub_directories = []
+        for entry in entries:
+            relative_path = (relative_directory + "/" + entry.name if relative_directory
+                                 else entry.name)
+            if symlinks == SKIP_SYMLINKS and entry.is_symlink():
+                continue
+            is_directory = entry.is_dir(follow_symlinks = symlinks == FOLLOW_SYMLINKS)
+            if (any(_matches(pattern, relative_path) for pattern in excludes)
+                    or _is_ignored(rules, relative_path, is_directory)):
+                continue
+            if is_directory:
+                sub_directories.append((entry.path, relative_path))
+            elif (entry.is_file()
+                      and any(_matches(pattern, relative_path) for pattern in includes)):
+                yield (entry.path, relative_path.replace("/", os.sep))
+        for path, relative_path in sub_directories:
+            for file in walk(path, relative_path, rules):
+                yield file
+    for file in walk(input_path, "", []):
+        yield file
@@ -31,12 +31,12 @@ class BeautifyCfengineCommand(sublime_plugin.TextCommand):
             buffer_region = sublime.Region(0, self.view.size())
             self.view.set_status(STATUS_KEY, "");
             try:
-                view_state = self.viewport_state()
-                self.view.replace(edit,
-                                  buffer_region,
-                                  beautifier.beautified_string(self.view.substr(buffer_region),
-                                                              options = self.options()))
-                self.set_viewport_state(view_state)
+                # Replacing only the changed parts keeps the selections and the viewport as they are
+                edits = beautifier.beautified_edits(self.view.substr(buffer_region),
+                                                    options = self.options())
+                # From the end, so that the positions of the preceding edits stay valid
+                for start_pos, end_pos, replacement in reversed(edits):
+                    self.view.replace(edit, sublime.Region(start_pos, end_pos), replacement)
             except ParserError as error:
                 error_region = sublime.Region(error.position, error.position + len(error.fragment))
                 self.view.add_regions("parser_errors", [error_region], "invalid.illegal", "circle")
@@ -60,13 +60,3 @@ class BeautifyCfengineCommand(sublime_plugin.TextCommand):
         options.line_endings = "\r\n" if self.view.line_endings() == "Windows" else "\n"
         return options
 
-    def viewport_state(self):
-        return { "selections" : map(lambda region: (region.a, region.b), self.view.sel()),
-                 "positions" : self.view.viewport_position() }
-
-    def set_viewport_state(self, state):
-        self.view.set_viewport_position((0, 0,), False)
-        self.view.set_viewport_position(state["positions"], False)
-        self.view.sel().clear()
-        for (a, b) in state["selections"]:
-            self.view.sel().add(sublime.Region(a, b))